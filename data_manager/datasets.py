@@ -1,8 +1,10 @@
+import os
 import numpy as np
 from torch.utils.data import Dataset
 from data_manager.data_prepare import Dcase18TaskbData
 from data_manager.dcase17_manager import Dcase17Data
 from data_manager.dcase17_stdrizer import Dcase17Standarizer
+from data_manager.shared_memory import shared_arrays
 
 """
 implement datasets class
@@ -15,14 +17,33 @@ class DevSet(Dataset):
     mode: train or test
     device: subset of abc(e.g. bc)
     transform: callable class
+    shared: if True, data is backed by shared memory, loaded once and mapped by all workers and experiment scripts.
+    fnames: if True, data is loaded with the int coded wav file names, kept in self.fnames (e.g. saved along the
+    embeddings by utils.embedding_store), else self.fnames is None.
     """
-    def __init__(self, mode='train', device='abc', transform=None):
+    def __init__(self, mode='train', device='abc', transform=None, shared=False, fnames=False):
         super(DevSet, self).__init__()
         self.data_manager = Dcase18TaskbData()
-        self.data, self.labels = self.data_manager.load_dev(mode=mode, devices=device)
-        self.data = np.expand_dims(self.data, axis=1)
+        if shared:
+            h5_path = self.data_manager.dev_matrix_fnames_h5_path if fnames else self.data_manager.dev_matrix_h5_path
+            prefix = 'taskb_{}{}_{}_'.format('fnames_' if fnames else '', mode, device)
+            name = prefix + str(int(os.path.getmtime(h5_path)))
+            arrays = shared_arrays(name, lambda: self._load(mode, device, fnames), n_arrays=3 if fnames else 2,
+                                   prefix=prefix)
+        else:
+            arrays = self._load(mode, device, fnames)
+        self.data = arrays[0]
+        self.labels = np.array(arrays[1])
+        self.fnames = np.array(arrays[2]) if fnames else None
         self.transform = transform
 
+    def _load(self, mode, device, fnames=False):
+        if fnames:
+            data, labels, fname_codes = self.data_manager.load_dev_with_fnames(mode=mode, devices=device)
+            return np.expand_dims(data, axis=1), labels, fname_codes
+        data, labels = self.data_manager.load_dev(mode=mode, devices=device)
+        return np.expand_dims(data, axis=1), labels
+
     def __len__(self):
         return len(self.data)
 
@@ -34,13 +55,24 @@ class DevSet(Dataset):
 
 
 class d17DevSet(Dataset):
-    def __init__(self, mode='train', fold_idx=1, transform=None):
+    def __init__(self, mode='train', fold_idx=1, transform=None, shared=False):
         super(d17DevSet, self).__init__()
         self.standarizer = Dcase17Standarizer(data_manager=Dcase17Data())
-        self.data, self.labels = self.standarizer.load_dev_standrized(fold_idx=fold_idx, mode=mode)
-        self.data = np.expand_dims(self.data, axis=1)
+        if shared:
+            version = max(os.path.getmtime(self.standarizer.data_manager.dev_matrix_h5_path),
+                          os.path.getmtime(self.standarizer.dev_scaler_h5))
+            prefix = 'd17_{}_fold{}_'.format(mode, fold_idx)
+            name = prefix + str(int(version))
+            self.data, labels = shared_arrays(name, lambda: self._load(mode, fold_idx), n_arrays=2, prefix=prefix)
+            self.labels = np.array(labels)
+        else:
+            self.data, self.labels = self._load(mode, fold_idx)
         self.transform = transform
 
+    def _load(self, mode, fold_idx):
+        data, labels = self.standarizer.load_dev_standrized(fold_idx=fold_idx, mode=mode)
+        return np.expand_dims(data, axis=1), labels
+
     def __len__(self):
         return len(self.data)
 
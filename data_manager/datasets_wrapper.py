@@ -3,6 +3,8 @@ from torch.utils.data import DataLoader
 from data_manager.data_prepare import Dcase18TaskbData
 from torch.utils.data.sampler import BatchSampler
 from data_manager.datasets import DevSet
+from utils.utilities import extract_embeddings, nearest_neighbour_graph
+import copy
 import numpy as np
 
 """
@@ -12,11 +14,15 @@ tripletDataset class: wrapper for Taskb_Development_set-like dataset, return ran
 class TripletDevSet(Dataset):
     """
     triplets wrapper, return triplets
+    (anchor, positive, negative) index tables are generated for a whole epoch at once from a seeded generator,
+    samples are then gathered by index. trainer.train_epoch(epoch=...) calls set_epoch() to draw new triplets
+    every epoch, test triplets are fixed.
     """
-    def __init__(self, mode='train', device='a', transform=None):
+    def __init__(self, mode='train', device='a', transform=None, seed=0):
         self.mode = mode
         self.device = device
         self.transform = transform
+        self.seed = seed
         self.data_manager = Dcase18TaskbData()
         self.data, self.labels = self.data_manager.load_dev(mode=self.mode, devices=self.device)
         self.data = np.expand_dims(self.data, axis=1)
@@ -24,31 +30,58 @@ class TripletDevSet(Dataset):
         self.labels_set = set(self.labels)
         self.label_to_indices = {label: np.where(self.labels == label)[0] for label in self.labels_set}
 
+        # class-sorted index table: samples of class c are sorted_indices[class_start[c]: class_start[c] + class_count[c]]
+        labels_list = np.array(sorted(self.labels_set))
+        self.label_pos = np.searchsorted(labels_list, self.labels)
+        self.sorted_indices = np.argsort(self.label_pos, kind='stable')
+        self.class_count = np.bincount(self.label_pos, minlength=len(labels_list))
+        self.class_start = np.concatenate(([0], np.cumsum(self.class_count)[:-1]))
+        # rank of every sample inside its class block
+        self.rank = np.empty(len(self.labels), dtype=np.int64)
+        self.rank[self.sorted_indices] = np.arange(len(self.labels)) - self.class_start[self.label_pos[self.sorted_indices]]
+
         if mode == 'test':
             # generate fixed triplets for testing
-            random_state = np.random.RandomState(29)
-            triplets = [[i, random_state.choice(self.label_to_indices[i]),
-                        random_state.choice(self.label_to_indices[
-                            np.random.choice(list(self.labels_set - set([i])))
-                                            ])]
-                       for i in range(len(self.data))]
-            self.test_triplets = triplets
+            self.triplets = self.generate_triplets(np.random.RandomState(29))
+        else:
+            self.set_epoch(0)
 
-    def __getitem__(self, index):
+    def generate_triplets(self, random_state):
+        """
+        draw one triplet for every anchor, vectorized.
+        positive is uniform over the anchor class without the anchor itself, negative class is uniform over other
+        classes, negative is uniform over that class.
+        :param random_state: np.random.RandomState
+        :return: int64 numpy of shape (n_samples, 3), columns are anchor, positive, negative indices
+        """
+        n_classes = len(self.class_count)
+        anchors = np.arange(len(self.labels))
+        count = self.class_count[self.label_pos]
+
+        offset = (random_state.random_sample(len(anchors)) * np.maximum(count - 1, 1)).astype(np.int64)
+        # skip the anchor itself inside its class block
+        offset += (offset >= self.rank) & (count > 1)
+        positives = self.sorted_indices[self.class_start[self.label_pos] + offset]
+
+        negative_pos = (self.label_pos + 1 + random_state.randint(0, max(n_classes - 1, 1), len(anchors))) % n_classes
+        offset = (random_state.random_sample(len(anchors)) * self.class_count[negative_pos]).astype(np.int64)
+        negatives = self.sorted_indices[self.class_start[negative_pos] + offset]
+
+        return np.stack((anchors, positives, negatives), axis=1)
+
+    def set_epoch(self, epoch):
+        """
+        regenerate the train triplets of given epoch, the same (seed, epoch) always gives the same triplets.
+        :param epoch:
+        :return:
+        """
         if self.mode == 'train':
-            data1, label1 = self.data[index], self.labels[index]
-            positive_index = index
-            while positive_index == index:
-                positive_index = np.random.choice(self.label_to_indices[label1])
-            negative_label = np.random.choice(list(self.labels_set - set([label1])))
-            negative_index = np.random.choice(self.label_to_indices[negative_label])
-            data2 = self.data[positive_index]
-            data3 = self.data[negative_index]
-            label2, label3 = self.labels[positive_index], self.labels[negative_index]
-        else:
-            data1 = self.data[self.test_triplets[index][0]]
-            data2 = self.data[self.test_triplets[index][1]]
-            data3 = self.data[self.test_triplets[index][2]]
+            self.triplets = self.generate_triplets(np.random.RandomState([self.seed, epoch]))
+
+    def __getitem__(self, index):
+        indices = self.triplets[index]
+        data1, data2, data3 = self.data[indices]
+        label1, label2, label3 = self.labels[indices]
 
         if self.transform is not None:
             data1 = self.transform(data1)
@@ -57,20 +90,95 @@ class TripletDevSet(Dataset):
 
         return (data1, data2, data3), (label1, label2, label3)
 
+    def __getitems__(self, indices):
+        """
+        batched path used by DataLoader, gather the data of a whole batch of triplets at once.
+        :param indices: list of triplet indices
+        :return: list of samples, same format as __getitem__
+        """
+        triplets = self.triplets[indices]
+        datas = self.data[triplets.reshape(-1)].reshape(triplets.shape + self.data.shape[1:])
+        labels = self.labels[triplets]
+        samples = []
+        for data, label in zip(datas, labels):
+            data = tuple(data)
+            if self.transform is not None:
+                data = tuple(self.transform(d) for d in data)
+            samples.append((data, tuple(label)))
+        return samples
+
     def __len__(self):
         return len(self.labels)
 
 
-class BalanceBatchSampler(BatchSampler):
+class ResumableBatchSampler(BatchSampler):
+    """
+    base class of seedable batch samplers whose batch stream can be checkpointed and resumed at the exact step.
+    subclasses draw all randomness from self.random_state, yield batches from _batches(), and list their mutable
+    attributes in _state_keys.
+    """
+    _state_keys = ()
+
+    def _init_state(self, seed):
+        # without a seed, derive one from the global generator, so np.random.seed() still reproduces a run
+        self.random_state = np.random.RandomState(seed if seed is not None else np.random.randint(2 ** 31 - 1))
+        self._epoch_state = None
+        self._resume_step = 0
+
+    def _snapshot(self):
+        state = {key: copy.deepcopy(getattr(self, key)) for key in self._state_keys}
+        state['random_state'] = self.random_state.get_state()
+        return state
+
+    def _restore(self, state):
+        for key in self._state_keys:
+            setattr(self, key, copy.deepcopy(state[key]))
+        self.random_state.set_state(state['random_state'])
+
+    def _batches(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        skip, self._resume_step = self._resume_step, 0
+        # dataloader workers prefetch ahead of training, so keep the epoch start state and count trained steps
+        self._epoch_state = self._snapshot()
+        for step, indices in enumerate(self._batches()):
+            if step >= skip:
+                yield indices
+
+    def state_dict(self, step=None):
+        """
+        serializable sampler state.
+        :param step: number of batches of the current epoch already trained, None at an epoch boundary
+        :return: dict
+        """
+        if step is None or self._epoch_state is None:
+            return {'sampler_state': self._snapshot(), 'step': 0}
+        return {'sampler_state': self._epoch_state, 'step': step}
+
+    def load_state_dict(self, state):
+        """
+        restore sampler state, the next iteration continues right after the saved step.
+        :param state: dict from state_dict()
+        :return:
+        """
+        self._restore(state['sampler_state'])
+        self._resume_step = state['step']
+
+
+class BalanceBatchSampler(ResumableBatchSampler):
     """
     batch sampler, randomly select n_classes, and n_samples each class
     """
-    def __init__(self, dataset, n_classes, n_samples):
+    _state_keys = ('labels_to_indices', 'used_label_indices_count', 'count')
+
+    def __init__(self, dataset, n_classes, n_samples, seed=None):
+        self._init_state(seed)
         self.labels = dataset.labels
         self.labels_set = list(set(self.labels))
         self.labels_to_indices = {label: np.where(self.labels == label)[0] for label in self.labels_set}
         for l in self.labels_set:
-            np.random.shuffle(self.labels_to_indices[l])
+            self.random_state.shuffle(self.labels_to_indices[l])
         self.used_label_indices_count = {label: 0 for label in self.labels_set}
         self.count = 0
         self.n_classes = n_classes
@@ -78,17 +186,17 @@ class BalanceBatchSampler(BatchSampler):
         self.batch_size = n_classes * n_samples
         self.dataset = dataset
 
-    def __iter__(self):
+    def _batches(self):
         self.count = 0
         while self.count + self.batch_size <= len(self.dataset):
-            classes = np.random.choice(self.labels_set, self.n_classes, replace=False)
+            classes = self.random_state.choice(self.labels_set, self.n_classes, replace=False)
             indices = []
             for class_ in classes:
                 indices.extend(self.labels_to_indices[class_][self.used_label_indices_count[class_] :
                                                               self.used_label_indices_count[class_] + self.n_samples])
                 self.used_label_indices_count[class_] += self.n_samples
                 if self.used_label_indices_count[class_] + self.n_samples > len(self.labels_to_indices[class_]):
-                    np.random.shuffle(self.labels_to_indices[class_])
+                    self.random_state.shuffle(self.labels_to_indices[class_])
                     self.used_label_indices_count[class_] = 0
             yield indices
             self.count += self.batch_size
@@ -97,6 +205,91 @@ class BalanceBatchSampler(BatchSampler):
         return len(self.dataset) // self.batch_size
 
 
+class RandomBatchSampler(ResumableBatchSampler):
+    """
+    plain shuffled batches of batch_size, last incomplete batch dropped. for proxy-based losses, which need no
+    class-balanced batches, resumable like the other samplers.
+    """
+    def __init__(self, dataset, batch_size, seed=None):
+        self._init_state(seed)
+        self.labels = dataset.labels
+        self.batch_size = batch_size
+        self.dataset = dataset
+
+    def _batches(self):
+        indices = self.random_state.permutation(len(self.dataset))
+        for i in range(len(self)):
+            yield [int(j) for j in indices[i * self.batch_size: (i + 1) * self.batch_size]]
+
+    def __len__(self):
+        return len(self.dataset) // self.batch_size
+
+
+class NeighbourBatchSampler(ResumableBatchSampler):
+    """
+    batch sampler driven by a dataset-wide nearest neighbour graph.
+    every batch is made of n_anchors random anchors, n_samples - 1 random positives of each anchor, and
+    n_neighbours nearest other-class samples of each anchor. call mine() every epoch, the graph is rebuilt with
+    the current model every `interval` epochs. before the first mine(), negatives are drawn at random.
+    """
+    _state_keys = ('graph',)
+
+    def __init__(self, dataset, n_anchors, n_samples, n_neighbours, interval=5, k_dims=64, batch_size=128,
+                 block_size=1024, seed=None):
+        self._init_state(seed)
+        self.labels = np.asarray(dataset.labels)
+        self.labels_set = list(set(self.labels))
+        self.labels_to_indices = {label: np.where(self.labels == label)[0] for label in self.labels_set}
+        self.negative_indices = {label: np.where(self.labels != label)[0] for label in self.labels_set}
+        self.n_anchors = n_anchors
+        self.n_samples = n_samples
+        self.n_neighbours = n_neighbours
+        self.batch_size = n_anchors * (n_samples + n_neighbours)
+        self.interval = interval
+        self.k_dims = k_dims
+        self.extract_batch_size = batch_size
+        self.block_size = block_size
+        self.dataset = dataset
+        self.graph = None
+
+    def mine(self, model, epoch=1):
+        """
+        embed the whole dataset with current model and rebuild the other-class k-NN graph.
+        :param model: embedding network
+        :param epoch: current epoch (1-based), the graph is only rebuilt when (epoch - 1) % interval == 0
+        :return: True if the graph was rebuilt
+        """
+        if self.graph is not None and (epoch - 1) % self.interval != 0:
+            return False
+        loader = DataLoader(dataset=self.dataset, batch_size=self.extract_batch_size, shuffle=False, num_workers=1)
+        embeddings, _ = extract_embeddings(loader, model, self.k_dims)
+        self.graph = nearest_neighbour_graph(embeddings, self.labels, k=self.n_neighbours, block_size=self.block_size)
+        return True
+
+    def _negatives(self, anchor):
+        if self.graph is not None:
+            return self.graph[anchor]
+        return self.random_state.choice(self.negative_indices[self.labels[anchor]], self.n_neighbours, replace=False)
+
+    def _batches(self):
+        anchors = self.random_state.permutation(len(self.dataset))
+        for i in range(len(self)):
+            indices = []
+            for anchor in anchors[i * self.n_anchors: (i + 1) * self.n_anchors]:
+                same_class = self.labels_to_indices[self.labels[anchor]]
+                positives = self.random_state.choice(same_class[same_class != anchor],
+                                             min(self.n_samples - 1, len(same_class) - 1), replace=False)
+                indices.append(anchor)
+                indices.extend(positives)
+                indices.extend(self._negatives(anchor))
+            # drop duplicates but keep the order
+            _, first = np.unique(indices, return_index=True)
+            yield [int(indices[j]) for j in np.sort(first)]
+
+    def __len__(self):
+        return len(self.dataset) // self.batch_size
+
+
 class DatasetWrapper(Dataset):
     def __init__(self, data, labels, transform=None):
         self.data = data
@@ -0,0 +1,115 @@
+import os
+import fcntl
+import shutil
+import tempfile
+import numpy as np
+
+"""
+shared-memory backing for dataset arrays.
+arrays are stored as .npy files in /dev/shm (POSIX shared memory tmpfs) and memory mapped, so dataloader workers and
+concurrently running experiment scripts all map the same physical copy of the spectrograms.
+"""
+
+SHM_DIR = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'asc_triplet')
+
+
+class SharedArray(object):
+    """
+    read-only view of a shared .npy file. pickled by path, so spawned workers re-attach instead of copying data.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.array = np.load(path, mmap_mode='r')
+
+    def __getitem__(self, index):
+        # copy the (small) sample out, downstream transforms expect a writable ndarray
+        return np.array(self.array[index])
+
+    def __len__(self):
+        return len(self.array)
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.array, dtype=dtype)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+
+def shared_arrays(name, load_fn, n_arrays=None, prefix=None):
+    """
+    attach to the shared arrays registered under name, the first caller creates them with load_fn().
+    creation is guarded by a file lock, so concurrent scripts load the source data only once. the arrays are written
+    to a temporary directory renamed in one step, a creator dying half way leaves no entry behind.
+    :param name: unique name of the arrays, should change when the source data changes
+    :param load_fn: callable returning a tuple of numpy arrays
+    :param n_arrays: number of arrays load_fn returns, an entry holding another number is rebuilt
+    :param prefix: name without its version (e.g. 'taskb_train_a_'), entries of other versions are removed
+    :return: tuple of SharedArray
+    """
+    if not os.path.exists(SHM_DIR):
+        os.makedirs(SHM_DIR, exist_ok=True)
+    entry = os.path.join(SHM_DIR, name)
+    # all versions share one lock, so removing an old version never races with its creation
+    lock_path = os.path.join(SHM_DIR, (prefix or name) + '.lock')
+    with open(lock_path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            for other in os.listdir(SHM_DIR):
+                if other != name and not other.endswith('.lock') and \
+                        (other.startswith(name + '.tmp') or (prefix is not None and other.startswith(prefix))):
+                    release_shared_arrays(other)
+            paths = _entry_paths(entry)
+            if paths is not None and n_arrays is not None and len(paths) != n_arrays:
+                release_shared_arrays(name)
+                paths = None
+            if paths is None:
+                paths = _create_entry(entry, load_fn())
+                print("[LOGGING]: Created shared memory", name)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return tuple(SharedArray(path) for path in paths)
+
+
+def _entry_paths(entry):
+    # .npy files of a complete entry in array order, None if there is no entry
+    if not os.path.isdir(entry):
+        return None
+    files = sorted((p for p in os.listdir(entry) if p.endswith('.npy')), key=lambda p: int(p.split('.')[0]))
+    return [os.path.join(entry, p) for p in files]
+
+
+def _create_entry(entry, arrays):
+    tmp_entry = entry + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_entry)
+    for i, array in enumerate(arrays):
+        shared = np.lib.format.open_memmap(os.path.join(tmp_entry, '{}.npy'.format(i)), mode='w+',
+                                           dtype=array.dtype, shape=array.shape)
+        shared[...] = array
+        shared.flush()
+        del shared
+    os.rename(tmp_entry, entry)
+    return _entry_paths(entry)
+
+
+def release_shared_arrays(name):
+    """
+    remove the shared arrays registered under name, processes already attached keep their mapping.
+    :param name:
+    :return:
+    """
+    path = os.path.join(SHM_DIR, name)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
@@ -86,6 +86,12 @@ def batch_all_split_device_exp(device='0', ckpt_prefix='Run01', lr=1e-3, embeddi
     for device in test_device_list:
         test_loader[device] = DataLoader(dataset=test_dataset[device], batch_size=batch_size, shuffle=False, num_workers=1)
 
+    # kNN gallery, every train sample once and in order
+    gallery_loader = {}
+    for device in train_device_list:
+        gallery_loader[device] = DataLoader(dataset=train_dataset[device], batch_size=batch_size, shuffle=False,
+                                            num_workers=1)
+
     # network architecture
     if embed_net == 'vgg':
         model = networks.vggish_bn()
@@ -110,6 +116,9 @@ def batch_all_split_device_exp(device='0', ckpt_prefix='Run01', lr=1e-3, embeddi
     ckpter = CheckPoint(model=model, optimizer=optimizer, path='{}/ckpt/batch_all_split_device_exp'.format(ROOT_DIR),
                         prefix=ckpt_prefix, interval=1, save_num=1)
 
+    # embeds each dataset once per model state, test device 'bc' is the concatenation of 'b' and 'c'
+    evaluator = GalleryEvaluator(model=model, unions={'bc': ('b', 'c')})
+
     # training embedding network
     for epoch in range(1, embedding_epochs + 1):
         scheduler.step()
@@ -122,9 +131,10 @@ def batch_all_split_device_exp(device='0', ckpt_prefix='Run01', lr=1e-3, embeddi
             train_logs[metric.name()] = metric.value()
         train_hist.add(logs=train_logs, epoch=epoch)
 
+        # gallery and every test split embedded once, 'bc' reuses 'b' and 'c'
+        test_acc = evaluator.kNN(gallery_loader=gallery_loader, query_loaders=test_loader, k=k)
         for device in test_device_list:
-            test_acc = kNN(model=model, train_loader=train_batch_loader, test_loader=test_loader[device], k=k)
-            test_logs = {'acc': test_acc}
+            test_logs = {'acc': test_acc[device]}
             val_hist[device].add(logs=test_logs, epoch=epoch)
 
         train_hist.clear()
@@ -77,6 +77,9 @@ def batch_all_total_with_knn_exp(device='0', ckpt_prefix='Run01', lr=1e-3, embed
     for device in device_list:
         test_loader[device] = DataLoader(dataset=test_dataset[device], batch_size=batch_size, shuffle=False, num_workers=1)
 
+    # kNN gallery, every train sample once and in order
+    gallery_loader = DataLoader(dataset=train_dataset, batch_size=batch_size, shuffle=False, num_workers=1)
+
     # network architecture
     if embed_net == 'vgg':
         model = networks.vggish_bn()
@@ -101,20 +104,24 @@ def batch_all_total_with_knn_exp(device='0', ckpt_prefix='Run01', lr=1e-3, embed
     ckpter = CheckPoint(model=model, optimizer=optimizer, path='{}/ckpt/batch_all_total_with_knn_exp'.format(ROOT_DIR),
                         prefix=ckpt_prefix, interval=1, save_num=1)
 
+    # embeds each dataset once per model state, test device 'bc' is the concatenation of 'b' and 'c'
+    evaluator = GalleryEvaluator(model=model, unions={'bc': ('b', 'c')})
+
     # training embedding network
     for epoch in range(1, embedding_epochs + 1):
         scheduler.step()
         train_loss, metrics = train_epoch(train_loader=train_batch_loader, model=model, loss_fn=loss_fn,
                                           optimizer=optimizer, log_interval=log_interval,
-                                          metrics=[AverageNoneZeroTripletsMetric()])
+                                          metrics=[AverageNoneZeroTripletsMetric()], epoch=epoch)
         train_logs = {'loss': train_loss}
         for metric in metrics:
             train_logs[metric.name()] = metric.value()
         train_hist.add(logs=train_logs, epoch=epoch)
 
+        # gallery and every test split embedded once, 'bc' reuses 'b' and 'c'
+        test_acc = evaluator.kNN(gallery_loader=gallery_loader, query_loaders=test_loader, k=k)
         for device in device_list:
-            test_acc = kNN(model=model, train_loader=train_batch_loader, test_loader=test_loader[device], k=k)
-            test_logs = {'acc': test_acc}
+            test_logs = {'acc': test_acc[device]}
             val_hist[device].add(logs=test_logs, epoch=epoch)
 
         train_hist.clear()
@@ -115,23 +115,26 @@ def triplet_loss_with_knn_exp(device='3', ckpt_prefix='Run01', lr=1e-3, dcase17_
     d18_ckpter = CheckPoint(model=model, optimizer=optimizer, path='{}/ckpt/transfer_{}_with_knn_exp'.format(ROOT_DIR, select_method),
                         prefix=(ckpt_prefix + 'Dcase18'), interval=1, save_num=1)
 
+    # embeds each dataset once per model state
+    evaluator = GalleryEvaluator(model=model)
+
     # training process
     for epoch in range(1, dcase17_epochs + 1):
         scheduler.step()
         train_loss, metrics = train_epoch(train_loader=d17_train_batch_loader, model=model, loss_fn=loss_fn,
                                           optimizer=optimizer, log_interval=log_interval,
-                                          metrics=[AverageNoneZeroTripletsMetric()])
+                                          metrics=[AverageNoneZeroTripletsMetric()], epoch=epoch)
         train_logs = dict()
         train_logs['loss'] = train_loss
         for metric in metrics:
             train_logs[metric.name()] = metric.value()
         d17_train_hist.add(logs=train_logs, epoch=epoch)
 
-        d17_test_acc = kNN(model=model, train_loader=d17_train_loader, test_loader=d17_test_loader, k=k, cls_num=15)
+        d17_test_acc = evaluator.kNN(gallery_loader=d17_train_loader, query_loaders=d17_test_loader, k=k, cls_num=15)
         d17_test_logs = {'acc': d17_test_acc}
         d17_val_hist.add(logs=d17_test_logs, epoch=epoch)
 
-        d18_test_acc = kNN(model=model, train_loader=d18_train_loader, test_loader=d18_test_loader, k=k, cls_num=10)
+        d18_test_acc = evaluator.kNN(gallery_loader=d18_train_loader, query_loaders=d18_test_loader, k=k, cls_num=10)
         d18_test_logs = {'acc': d18_test_acc}
         d18_val_hist.add(logs=d18_test_logs, epoch=epoch)
 
@@ -173,14 +176,14 @@ def triplet_loss_with_knn_exp(device='3', ckpt_prefix='Run01', lr=1e-3, dcase17_
 
         train_loss, metrics = train_epoch(train_loader=d18_train_batch_loader, model=model, loss_fn=loss_fn,
                                           optimizer=optimizer, log_interval=log_interval,
-                                          metrics=[AverageNoneZeroTripletsMetric()])
+                                          metrics=[AverageNoneZeroTripletsMetric()], epoch=epoch)
         train_logs = dict()
         train_logs['loss'] = train_loss
         for metric in metrics:
             train_logs[metric.name()] = metric.value()
         d18_train_hist.add(logs=train_logs, epoch=epoch)
 
-        d18_test_acc = kNN(model=model, train_loader=d18_train_loader, test_loader=d18_test_loader, k=k, cls_num=10)
+        d18_test_acc = evaluator.kNN(gallery_loader=d18_train_loader, query_loaders=d18_test_loader, k=k, cls_num=10)
         d18_test_logs = {'acc': d18_test_acc}
         d18_val_hist.add(logs=d18_test_logs, epoch=epoch)
 
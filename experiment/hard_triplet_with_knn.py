@@ -19,6 +19,7 @@ import logging
 from utils.history import *
 from utils.checkpoint import *
 from utils.utilities import *
+from utils.embedding_store import EmbeddingStore
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -54,14 +55,15 @@ def hard_triplet_with_knn_exp(device='3', ckpt_prefix='Run01', lr=1e-3, embeddin
     mu, sigma = standarizer.load_mu_sigma(mode='train', device='a')
 
     # get the normalized train dataset
+    # fname codes are saved with the stored embeddings of the classifier stage
     train_dataset = DevSet(mode='train', device='a', transform=Compose([
         Normalize(mean=mu, std=sigma),
         ToTensor()
-    ]))
+    ]), fnames=True)
     test_dataset = DevSet(mode='test', device='a', transform=Compose([
         Normalize(mean=mu, std=sigma),
         ToTensor()
-    ]))
+    ]), fnames=True)
 
     train_batch_sampler = BalanceBatchSampler(dataset=train_dataset, n_classes=n_classes, n_samples=n_samples)
     train_batch_loader = DataLoader(dataset=train_dataset, batch_sampler=train_batch_sampler, num_workers=1)
@@ -93,7 +95,7 @@ def hard_triplet_with_knn_exp(device='3', ckpt_prefix='Run01', lr=1e-3, embeddin
         scheduler.step()
         train_loss, metrics = train_epoch(train_loader=train_batch_loader, model=model, loss_fn=loss_fn,
                                           optimizer=optimizer, log_interval=log_interval,
-                                          metrics=[AverageNoneZeroTripletsMetric()])
+                                          metrics=[AverageNoneZeroTripletsMetric()], epoch=epoch)
         train_logs = dict()
         train_logs['loss'] = train_loss
         for metric in metrics:
@@ -126,8 +128,10 @@ def hard_triplet_with_knn_exp(device='3', ckpt_prefix='Run01', lr=1e-3, embeddin
     best_model_filename = Reporter(ckpt_root=os.path.join(ROOT_DIR, 'ckpt'), exp='hard_triplet_with_knn_exp').select_best(run=ckpt_prefix).selected_ckpt
     model.load_state_dict(torch.load(best_model_filename)['model_state_dict'])
 
-    train_embedding, train_labels = extract_embeddings(train_batch_loader, model, embed_dims)
-    test_embedding, test_labels = extract_embeddings(test_batch_loader, model, embed_dims)
+    # embeddings of the best checkpoint are extracted once, reruns of the classifier stage load them
+    store = EmbeddingStore()
+    train_embedding, train_labels = store.extract(train_batch_loader, model, embed_dims, checkpoint=best_model_filename)
+    test_embedding, test_labels = store.extract(test_batch_loader, model, embed_dims, checkpoint=best_model_filename)
 
     classify_train_dataset = DatasetWrapper(data=train_embedding, labels=train_labels, transform=ToTensor())
     classify_test_dataset = DatasetWrapper(data=test_embedding, labels=test_labels, transform=ToTensor())
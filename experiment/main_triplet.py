@@ -19,6 +19,10 @@ import logging
 from utils.history import *
 from utils.checkpoint import *
 from utils.utilities import *
+from utils.loader_tuner import tuned_loader
+from utils.embedding_store import EmbeddingStore
+from utils.gallery import IVFIndex, PQIndex, INDEX_TYPES
+from utils.condensation import condensation_report
 from experiment.xgb import xgb_cls
 import configparser
 import losses
@@ -72,7 +76,7 @@ def cross_entropy_pretrain(config, model, train_dataset, test_dataset):
             pt_scheduler.step()
             train_loss, metrics = train_epoch(train_loader=train_loader, model=model, loss_fn=pt_loss_fn,
                                               optimizer=pt_optimizer, log_interval=80,
-                                              metrics=[AccumulatedAccuracyMetric()])
+                                              metrics=[AccumulatedAccuracyMetric()], epoch=epoch)
             train_logs = {'loss': train_loss}
             for metric in metrics:
                 train_logs[metric.name()] = metric.value()
@@ -104,37 +108,126 @@ def cross_entropy_pretrain(config, model, train_dataset, test_dataset):
     return model
 
 
+def build_loss(config, name, model, train_loader):
+    """
+    build one loss of losses.py from the [EMBEDDING] section.
+    :param config:
+    :param name: class name in losses.py
+    :param model: embedding network, its classification layer is the head of CrossEntropyHeadLoss
+    :param train_loader: train set loader, the number of classes of proxy losses comes from it
+    :return: loss module
+    """
+    loss_cls = getattr(losses, name)
+    if loss_cls is CrossEntropyHeadLoss:
+        return CrossEntropyHeadLoss(head=nn.Sequential(nn.ReLU(), model.cls))
+
+    loss_kwargs = {}
+    if int(config['EMBEDDING'].get('memory_size', 0)) > 0 and \
+            issubclass(loss_cls, (BatchHardTripletLoss, BatchAllTripletLoss, LargeMarginLoss)):
+        # cross-batch memory, mine positives and negatives among the recent embeddings too
+        loss_kwargs['memory'] = EmbeddingMemory(size=int(config['EMBEDDING']['memory_size']))
+    if issubclass(loss_cls, ProxyLoss):
+        loss_kwargs['n_classes'] = len(set(train_loader.dataset.labels))
+        loss_kwargs['embed_dim'] = int(config['EMBEDDING'].get('embed_dims', 64))
+    return loss_cls(margin=float(config['EMBEDDING']['margin']),
+                    squared=config['EMBEDDING'].getboolean('squared'),
+                    **loss_kwargs)
+
+
+def build_index(config):
+    """
+    gallery index of the kNN evaluation, [KNN] index = exact (brute force), ivf, float16, int8 or pq.
+    without index, n_probe > 0 selects ivf and brute force is the default.
+    :param config:
+    :return: unbuilt utils.gallery index, None for brute force
+    """
+    n_probe = int(config['KNN'].get('n_probe', 0))
+    kind = config['KNN'].get('index', 'ivf' if n_probe > 0 else 'exact')
+    if kind != 'ivf' and n_probe > 0:
+        raise ValueError('[KNN] n_probe = {} is only used by index = ivf, not {}'.format(n_probe, kind))
+    if kind == 'exact':
+        return None
+    if kind == 'ivf':
+        return IVFIndex(n_probe=n_probe if n_probe > 0 else 8)
+    if kind == 'pq':
+        return PQIndex(n_subspaces=int(config['KNN'].get('n_subspaces', 8)))
+    return INDEX_TYPES[kind]()
+
+
 def train_triplet(config, model, train_balanced_loader,  train_loader, test_loader):
 
-    if config['EMBEDDING']['saved_ckpt'] == 'None':
+    normalized = config['EMBEDDING'].getboolean('normalize', fallback=False)
+    if normalized:
+        # unit length embeddings, losses and kNN work on dot products
+        model = networks.l2_normalized(model)
 
-        loss_fn = getattr(losses, config['EMBEDDING']['triplet_loss'])(margin=float(config['EMBEDDING']['margin']),
-                                                                    squared=config['EMBEDDING'].getboolean('squared'))
+    if config['EMBEDDING']['saved_ckpt'] == 'None':
 
-        optimizer = optim.Adam(model.parameters(),
+        # "BatchHardTripletLoss + LargeMarginLoss" builds a CompositeLoss weighted by loss_weights
+        loss_names = [name.strip() for name in config['EMBEDDING']['triplet_loss'].split('+')]
+        member_losses = [build_loss(config, name, model, train_loader) for name in loss_names]
+        if len(member_losses) > 1:
+            weights = [float(w) for w in config['EMBEDDING'].get('loss_weights', ','.join(['1'] * len(loss_names)))
+                       .split(',')]
+            loss_fn = CompositeLoss(member_losses, weights=weights).cuda()
+        else:
+            loss_fn = member_losses[0].cuda()
+        if normalized and hasattr(loss_fn, 'set_normalized'):
+            loss_fn.set_normalized(True)
+
+        # learnable loss parameters (class proxies) are optimized with their own, usually larger, learning rate
+        params = [{'params': model.parameters()}]
+        model_params = set(id(p) for p in model.parameters())
+        loss_params = [p for p in loss_fn.parameters() if id(p) not in model_params]
+        if len(loss_params) > 0:
+            params.append({'params': loss_params,
+                           'lr': float(config['EMBEDDING'].get('proxy_lr', config['EMBEDDING']['lr']))})
+        optimizer = optim.Adam(params,
                                lr=float(config['EMBEDDING']['lr']),
                                weight_decay=float(config['EMBEDDING']['l2']))
         scheduler = lr_scheduler.StepLR(optimizer=optimizer, step_size=30, gamma=0.5)
 
+        train_metrics = [AverageNoneZeroTripletsMetric()]
+        if isinstance(loss_fn, BatchAllWithOutlierTripletLoss):
+            train_metrics.append(AverageOutlierMetric())
+        if isinstance(loss_fn, CompositeLoss):
+            train_metrics.extend(CompositeMemberMetric(member=i, name='loss/' + name)
+                                 for i, name in enumerate(loss_names))
+
         train_hist = History(name='train/a')
         val_hist = History(name='test/a')
         ckpter = CheckPoint(model=model,
                             optimizer=optimizer,
                             path='{}/experiment/ckpt/{}'.format(ROOT_DIR, config['MAIN']['experiment']),
-                            prefix=config['MAIN']['ckpt_prefix'], interval=1, save_num=1)
+                            prefix=config['MAIN']['ckpt_prefix'], interval=1, save_num=1,
+                            sampler=train_balanced_loader.batch_sampler, loss_fn=loss_fn)
+
+        # resume at the exact step of an interrupted run
+        start_epoch, start_step = 1, 0
+        if config['EMBEDDING'].get('resume', 'None') != 'None':
+            start_epoch, start_step = ckpter.load_resume(os.path.join(ckpter.path, config['EMBEDDING']['resume']))
+        for epoch in range(1, start_epoch):
+            scheduler.step()
 
-        for epoch in range(1, int(config['EMBEDDING']['epochs']) + 1):
+        for epoch in range(start_epoch, int(config['EMBEDDING']['epochs']) + 1):
             scheduler.step()
+            # offline mining stage, only for graph-driven batch samplers, a mid-epoch resume restores the graph
+            if hasattr(train_balanced_loader.batch_sampler, 'mine') and start_step == 0:
+                train_balanced_loader.batch_sampler.mine(model=model, epoch=epoch)
             train_loss, metrics = train_epoch(train_loader=train_balanced_loader, model=model, loss_fn=loss_fn,
                                               optimizer=optimizer, log_interval=80,
-                                              metrics=[AverageNoneZeroTripletsMetric()])
+                                              metrics=train_metrics, ckpter=ckpter, epoch=epoch,
+                                              save_interval=int(config['EMBEDDING'].get('resume_interval', 0)),
+                                              start_step=start_step)
+            start_step = 0
             train_logs = dict()
             train_logs['loss'] = train_loss
             for metric in metrics:
                 train_logs[metric.name()] = metric.value()
             train_hist.add(logs=train_logs, epoch=epoch)
 
-            test_acc = kNN(model=model, train_loader=train_loader, test_loader=test_loader, k=int(config['KNN']['k']))
+            test_acc = kNN(model=model, train_loader=train_loader, test_loader=test_loader, k=int(config['KNN']['k']),
+                           normalized=normalized, index=build_index(config))
             test_logs = {'acc': test_acc}
             val_hist.add(logs=test_logs, epoch=epoch)
 
@@ -144,6 +237,7 @@ def train_triplet(config, model, train_balanced_loader,  train_loader, test_load
             logging.info('Epoch{:04d}, {:15}, {}'.format(epoch, train_hist.name, str(train_hist.recent)))
             logging.info('Epoch{:04d}, {:15}, {}'.format(epoch, val_hist.name, str(val_hist.recent)))
             ckpter.check_on(epoch=epoch, monitor='acc', loss_acc=val_hist.recent)
+            ckpter.save_resume(epoch=epoch)
 
         # reload best embedding model
         best_model_filename = Reporter(ckpt_root=os.path.join(ROOT_DIR, 'experiment/ckpt'), exp=config['MAIN']['experiment']).\
@@ -172,14 +266,15 @@ def run(config_file='config/large_margin.cfg'):
     mu, sigma = standarizer.load_mu_sigma(mode='train', device='a')
 
     # get the normalized train dataset
+    shared = config['MAIN'].getboolean('shared_memory', fallback=False)
     train_dataset = DevSet(mode='train', device='a', transform=Compose([
         Normalize(mean=mu, std=sigma),
         ToTensor()
-    ]))
+    ]), shared=shared)
     test_dataset = DevSet(mode='test', device='a', transform=Compose([
         Normalize(mean=mu, std=sigma),
         ToTensor()
-    ]))
+    ]), shared=shared)
 
     model = getattr(networks, config['MAIN']['net'])()
     model = model.cuda()
@@ -187,19 +282,53 @@ def run(config_file='config/large_margin.cfg'):
     if config['CE_PRETRAIN'].getboolean('enable'):
         model = cross_entropy_pretrain(config, model, train_dataset, test_dataset)
 
-    train_batch_sampler = BalanceBatchSampler(dataset=train_dataset,
-                                              n_classes=int(config['EMBEDDING']['n_classes']),
-                                              n_samples=int(config['EMBEDDING']['n_samples']))
-    train_balanced_loader = DataLoader(dataset=train_dataset, batch_sampler=train_batch_sampler, num_workers=1)
-    train_loader = DataLoader(dataset=train_dataset, batch_size=int(config['EMBEDDING']['batch_size']),
-                              shuffle=False, num_workers=1)
+    if config['EMBEDDING'].get('batch_sampler', 'BalanceBatchSampler') == 'NeighbourBatchSampler':
+        train_batch_sampler = NeighbourBatchSampler(dataset=train_dataset,
+                                                    n_anchors=int(config['EMBEDDING']['n_anchors']),
+                                                    n_samples=int(config['EMBEDDING']['n_samples']),
+                                                    n_neighbours=int(config['EMBEDDING']['n_neighbours']),
+                                                    interval=int(config['EMBEDDING'].get('mine_interval', 5)),
+                                                    batch_size=int(config['EMBEDDING']['batch_size']))
+    elif config['EMBEDDING'].get('batch_sampler', 'BalanceBatchSampler') == 'RandomBatchSampler':
+        # proxy-based losses need no class-balanced batches
+        train_batch_sampler = RandomBatchSampler(dataset=train_dataset, batch_size=int(config['EMBEDDING']['batch_size']))
+    else:
+        train_batch_sampler = BalanceBatchSampler(dataset=train_dataset,
+                                                  n_classes=int(config['EMBEDDING']['n_classes']),
+                                                  n_samples=int(config['EMBEDDING']['n_samples']))
+    if config['MAIN'].getboolean('tune_loader', fallback=False):
+        # probe workers/prefetch/pinning once per machine and dataset, cached afterwards
+        train_balanced_loader = tuned_loader(dataset=train_dataset, batch_sampler=train_batch_sampler)
+        train_loader = tuned_loader(dataset=train_dataset, batch_size=int(config['EMBEDDING']['batch_size']))
+        test_loader = tuned_loader(dataset=test_dataset, batch_size=int(config['EMBEDDING']['batch_size']))
+    else:
+        train_balanced_loader = DataLoader(dataset=train_dataset, batch_sampler=train_batch_sampler, num_workers=1)
+        train_loader = DataLoader(dataset=train_dataset, batch_size=int(config['EMBEDDING']['batch_size']),
+                                  shuffle=False, num_workers=1)
 
-    test_loader = DataLoader(dataset=test_dataset, batch_size=int(config['EMBEDDING']['batch_size']),
-                             shuffle=False, num_workers=1)
+        test_loader = DataLoader(dataset=test_dataset, batch_size=int(config['EMBEDDING']['batch_size']),
+                                 shuffle=False, num_workers=1)
     model = train_triplet(config, model, train_balanced_loader, train_loader, test_loader)
 
-    # train_embedding, train_labels = extract_embeddings(train_loader, model, embed_dims)
-    # test_embedding, test_labels = extract_embeddings(test_loader, model, embed_dims)
+    if int(config['KNN'].get('k_max', 0)) > 0:
+        # every k and voting scheme of the best model from one neighbour search
+        report = kNN_report(model=model, train_loader=train_loader, test_loader=test_loader,
+                            k_max=int(config['KNN']['k_max']),
+                            normalized=config['EMBEDDING'].getboolean('normalize', fallback=False))
+        logging.info('kNN best {} voting, k={}, acc {:.4f}'.format(*report['best']))
+
+    if config['KNN'].getboolean('condense', fallback=False):
+        # accuracy versus size of condensed train galleries, embeddings are kept in the store for later runs
+        store = EmbeddingStore()
+        train_embedding, train_labels = store.extract(train_loader, model)
+        test_embedding, test_labels = store.extract(test_loader, model)
+        for row in condensation_report(train_embedding, train_labels, test_embedding, test_labels,
+                                       k=int(config['KNN']['k'])):
+            logging.info('condensed gallery {method}: {size} samples, k={k}, acc {acc:.4f}'.format(**row))
+
+    # store = EmbeddingStore()
+    # train_embedding, train_labels = store.extract(train_loader, model, embed_dims)
+    # test_embedding, test_labels = store.extract(test_loader, model, embed_dims)
     #
     # xgb_cls(train_data=train_embedding, train_label=train_labels, val_data=test_embedding, val_label=test_labels,
     #         exp_dir=os.path.dirname('{}/ckpt/{}/{}.log'.format(ROOT_DIR,
@@ -93,7 +93,7 @@ def triplet_loss_with_knn_exp(device='3', ckpt_prefix='Run01', lr=1e-3, embeddin
                 pt_scheduler.step()
                 train_loss, metrics = train_epoch(train_loader=train_batch_loader, model=model, loss_fn=pt_loss_fn,
                                                   optimizer=pt_optimizer, log_interval=log_interval,
-                                                  metrics=[AccumulatedAccuracyMetric()])
+                                                  metrics=[AccumulatedAccuracyMetric()], epoch=epoch)
                 train_logs = {'loss': train_loss}
                 for metric in metrics:
                     train_logs[metric.name()] = metric.value()
@@ -141,7 +141,7 @@ def triplet_loss_with_knn_exp(device='3', ckpt_prefix='Run01', lr=1e-3, embeddin
             scheduler.step()
             train_loss, metrics = train_epoch(train_loader=train_batch_loader, model=model, loss_fn=loss_fn,
                                               optimizer=optimizer, log_interval=log_interval,
-                                              metrics=[AverageNoneZeroTripletsMetric()])
+                                              metrics=[AverageNoneZeroTripletsMetric()], epoch=epoch)
             train_logs = dict()
             train_logs['loss'] = train_loss
             for metric in metrics:
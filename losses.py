@@ -9,6 +9,107 @@ from utils.utilities import *
 import logging
 
 
+def blocked_batch_all_triplet_loss(pairwise_dist, labels, margin, soft_margin=False, anchor_weights=None,
+                                   memory_budget=2 ** 22, candidate_labels=None):
+    """
+    sum of all valid triplet losses, computed class by class in anchor chunks.
+    for anchors of class c only (positive of class c, negative of other classes) triplets are built, at most
+    memory_budget of them at once. the gradient w.r.t. pairwise_dist is accumulated in a (batch_size, batch_size)
+    matrix instead of keeping every chunk for backward, so it stays exact with O(batch_size^2) memory.
+    :param pairwise_dist: tensor of shape (batch_size, batch_size)
+    :param labels: tensor of shape (batch_size, )
+    :param margin: margin for triplet loss, unused with soft margin
+    :param soft_margin: use log(1 + exp(ap - an)) instead of hinge
+    :param anchor_weights: optional tensor of shape (batch_size, ) without grad, scales the loss of each anchor
+    :param memory_budget: max number of (anchor, positive, negative) elements computed at once
+    :param candidate_labels: labels of the columns of pairwise_dist if it is (batch_size, n) with n > batch_size,
+                             the first batch_size columns must be the batch itself (e.g. batch + memory bank)
+    :return: sum of triplet losses (differentiable), number of hard triplets (where triplet_loss > 0)
+    """
+    candidate_labels = labels if candidate_labels is None else candidate_labels
+    dist = pairwise_dist.detach()
+    grad = torch.zeros_like(dist)
+    total_loss = dist.new_zeros(())
+    num_hard_triplets = dist.new_zeros(())
+
+    for label in torch.unique(labels):
+        anchor_indices = torch.nonzero(torch.eq(labels, label)).view(-1)
+        class_mask = torch.eq(candidate_labels, label)
+        positive_indices = torch.nonzero(class_mask).view(-1)
+        negative_indices = torch.nonzero(~class_mask).view(-1)
+        if len(positive_indices) < 2 or len(negative_indices) == 0:
+            continue
+
+        chunk_size = max(1, memory_budget // (len(positive_indices) * len(negative_indices)))
+        for start in range(0, len(anchor_indices), chunk_size):
+            anchors = anchor_indices[start: start + chunk_size]
+            anchor_dist = dist[anchors]
+            # shape (chunk_size, n_positives, n_negatives)
+            triplet_loss = anchor_dist[:, positive_indices].unsqueeze(2) - anchor_dist[:, negative_indices].unsqueeze(1)
+            # anchor and positive must be distinct, negatives always differ by label
+            valid = torch.ne(anchors.unsqueeze(1), positive_indices.unsqueeze(0)).unsqueeze(2).to(dist.dtype)
+
+            if soft_margin:
+                weight = torch.sigmoid(triplet_loss) * valid
+                triplet_loss = torch.log1p(torch.exp(triplet_loss)) * valid
+            else:
+                triplet_loss = F.relu((triplet_loss + margin) * valid)
+                weight = torch.gt(triplet_loss, 0).to(dist.dtype)
+
+            num_hard_triplets += torch.sum(torch.gt(triplet_loss, 1e-16).to(dist.dtype))
+            if anchor_weights is not None:
+                chunk_weights = anchor_weights[anchors].view(-1, 1, 1).to(dist.dtype)
+                triplet_loss = triplet_loss * chunk_weights
+                weight = weight * chunk_weights
+            total_loss += torch.sum(triplet_loss)
+
+            # d loss / d ap and d loss / d an
+            grad[anchors.unsqueeze(1), positive_indices.unsqueeze(0)] += weight.sum(dim=2)
+            grad[anchors.unsqueeze(1), negative_indices.unsqueeze(0)] -= weight.sum(dim=1)
+
+    # value of total_loss, gradient of sum(grad * pairwise_dist)
+    surrogate = torch.sum(pairwise_dist * grad)
+    return surrogate + (total_loss - surrogate).detach(), num_hard_triplets
+
+
+class EmbeddingMemory(nn.Module):
+    """
+    cross-batch memory, a ring buffer of the most recent detached embeddings and labels.
+    losses mine anchor-to-memory pairs in addition to in-batch ones, then enqueue the current batch. buffers are
+    allocated on the device of the first enqueued embeddings.
+    """
+    def __init__(self, size=1024):
+        super(EmbeddingMemory, self).__init__()
+        self.size = size
+        # not persistent, a resumed run refills the memory within a few batches
+        self.register_buffer('embeddings', torch.zeros(0), persistent=False)
+        self.register_buffer('labels', torch.zeros(0, dtype=torch.long), persistent=False)
+        self.ptr = 0
+        self.filled = 0
+
+    def enqueue(self, embeddings, labels):
+        embeddings = embeddings.detach()
+        if self.embeddings.numel() == 0:
+            self.embeddings = embeddings.new_zeros(self.size, embeddings.shape[1])
+            self.labels = labels.new_zeros(self.size)
+        n = min(len(embeddings), self.size)
+        indices = (self.ptr + torch.arange(n, device=embeddings.device)) % self.size
+        # out of place, the previous buffers may still be needed by the backward pass of the current loss
+        self.embeddings = self.embeddings.index_copy(0, indices, embeddings[-n:])
+        self.labels = self.labels.index_copy(0, indices, labels[-n:])
+        self.ptr = (self.ptr + n) % self.size
+        self.filled = min(self.filled + n, self.size)
+
+    def get(self):
+        """
+        :return: stored embeddings (n, embed_dim) and labels (n, ), n <= size
+        """
+        return self.embeddings[:self.filled], self.labels[:self.filled]
+
+    def __len__(self):
+        return self.filled
+
+
 class RandomHardTripletLoss(nn.Module):
     """
     online triplet loss
@@ -27,6 +128,9 @@ class RandomHardTripletLoss(nn.Module):
 
         if embeddings.is_cuda:
             triplets = triplets.cuda()
+        if len(triplets) == 0:
+            # no valid triplet in the batch (e.g. every class has one sample), zero loss still attached to the graph
+            return embeddings.sum() * 0, 0
 
         ap_distances = (embeddings[triplets[:, 0]] - embeddings[triplets[:, 1]]).pow(2).sum(1)
         an_distances = (embeddings[triplets[:, 0]] - embeddings[triplets[:, 2]]).pow(2).sum(1)
@@ -43,34 +147,60 @@ class RandomHardTripletLoss(nn.Module):
         return triplet_loss.mean(), len(triplets)
 
 
-class BatchHardTripletLoss(nn.Module):
+class PairwiseLoss(nn.Module):
+    """
+    base class of losses on in-batch pairwise distances. forward_batch takes a PairwiseBatch, so the distances,
+    masks and kernels of a batch can be shared by several losses (see CompositeLoss).
+    """
+    # embeddings are unit length (networks.l2_normalized), distances come from dot products only
+    normalized = False
+
+    def set_normalized(self, normalized):
+        self.normalized = normalized
+        return self
+
+    def forward(self, embeddings, labels):
+        """
+
+        :param embeddings: tensor of shape (batch_size, embed_dim)
+        :param labels: tensor of shape (batch_size, )
+        :return: loss and number of triplets, other loss specific outputs may follow
+        """
+        return self.forward_batch(PairwiseBatch(embeddings, labels, normalized=self.normalized))
+
+    def forward_batch(self, batch):
+        raise NotImplementedError
+
+
+class BatchHardTripletLoss(PairwiseLoss):
     """
     Batch_Hard Triplet Loss
     """
-    def __init__(self, margin=0.1, squared=False, soft_margin=True):
+    def __init__(self, margin=0.1, squared=False, soft_margin=True, memory=None):
         """
         :param margin: margin for triplet loss
         :param squared: if True, output is the pairwise squared euclidean distance matrix.
                         if False, output is the pairwise euclidean distance matrix.
+        :param memory: optional EmbeddingMemory, hardest positives and negatives are also mined in it
         """
         super(BatchHardTripletLoss, self).__init__()
         self.margin = margin
         self.squared = squared
         self.soft_margin = soft_margin
+        self.memory = memory
 
-    def forward(self, embeddings, labels):
+    def hardest_dist(self, batch):
         """
-
-        :param embeddings: tensor of shape (batch_size, embed_dim)
-        :param labels: tensor of shape (batch_size, )
-        :return: triplet_loss and number of triplets
+        distance of every anchor to its hardest positive and hardest negative inside the batch.
+        :param batch: PairwiseBatch
+        :return: two tensors of shape (batch_size, 1)
         """
-
-        pairwise_dist = pairwise_distance(embeddings, squared=self.squared)
+        masks = batch.masks
+        pairwise_dist = batch.distance(self.squared)
 
         # get the hardest positive pairs (they should have biggest distance)
         # First, get a mask for every valid positive (they should have same label)
-        mask_anchor_positive = get_anchor_positive_triplet_mask(labels).float()
+        mask_anchor_positive = masks.anchor_positive.float()
 
         # put to zero any element where (a, p) is not valid (valid if a != p and label(a) == label(p))
         valid_positive_dist = pairwise_dist * mask_anchor_positive
@@ -80,7 +210,7 @@ class BatchHardTripletLoss(nn.Module):
 
         # for each anchor, get the hardest negative (they should have smallest distance)
         # First, we need to get a mask for every valid negative (they should have different labels)
-        mask_anchor_negative = get_anchor_negative_triplet_mask(labels).float()
+        mask_anchor_negative = masks.anchor_negative.float()
 
         # We add the maximum value in each row to the invalid negatives (label(a) == label(n))
         max_anchor_negative_dist, _ = torch.max(pairwise_dist, dim=1, keepdim=True)
@@ -88,6 +218,24 @@ class BatchHardTripletLoss(nn.Module):
 
         # shape (batch_size, 1)
         hardest_negative_dist, _ = torch.min(anchor_negative_dist, dim=1, keepdim=True)
+        return hardest_positive_dist, hardest_negative_dist
+
+    def forward_batch(self, batch):
+        embeddings, labels = batch.embeddings, batch.labels
+        hardest_positive_dist, hardest_negative_dist = self.hardest_dist(batch)
+
+        if self.memory is not None and len(self.memory) > 0:
+            memory_embeddings, memory_labels = self.memory.get()
+            memory_dist = cross_distance(embeddings, memory_embeddings, squared=self.squared,
+                                         normalized=self.normalized)
+            memory_positive_mask = torch.eq(labels.unsqueeze(1), memory_labels.unsqueeze(0))
+            memory_positive_dist, _ = torch.max(memory_dist * memory_positive_mask.float(), dim=1, keepdim=True)
+            memory_negative_dist, _ = torch.min(memory_dist.masked_fill(memory_positive_mask, float('inf')),
+                                                dim=1, keepdim=True)
+            hardest_positive_dist = torch.max(hardest_positive_dist, memory_positive_dist)
+            hardest_negative_dist = torch.min(hardest_negative_dist, memory_negative_dist)
+        if self.memory is not None:
+            self.memory.enqueue(embeddings, labels)
 
         if self.soft_margin:
             # Combine biggest d(a, p) and smallest d(a, n) into final triplet loss
@@ -106,30 +254,106 @@ class BatchHardTripletLoss(nn.Module):
         return triplet_loss, num_hard_triplets
 
 
-class BatchAllTripletLoss(nn.Module):
+class BatchHardDistance(torch.autograd.Function):
+    """
+    hardest positive and hardest negative distance of every anchor, same selection as BatchHardTripletLoss.
+    forward keeps only the selected indices, no (batch_size, batch_size) intermediate is saved for backward.
+    backward scatters the gradient to the anchor and its two selected samples.
+    """
+    @staticmethod
+    def forward(ctx, embeddings, anchor_positive_mask, anchor_negative_mask, squared, normalized=False):
+        """
+        :param embeddings: tensor of shape (batch_size, embed_dim)
+        :param anchor_positive_mask: bool tensor of shape (batch_size, batch_size)
+        :param anchor_negative_mask: bool tensor of shape (batch_size, batch_size)
+        :param squared: Boolean, squared euclidean distance if True
+        :param normalized: Boolean, unit length embeddings, squared distance is 2 - 2 * dot product
+        :return: hardest positive distance and hardest negative distance, tensors of shape (batch_size, )
+        """
+        pairwise_dist = pairwise_distance(embeddings, squared=squared, normalized=normalized)
+        hardest_positive_dist, positive_indices = torch.max(pairwise_dist * anchor_positive_mask, dim=1)
+        max_anchor_negative_dist, _ = torch.max(pairwise_dist, dim=1, keepdim=True)
+        hardest_negative_dist, negative_indices = torch.min(
+            pairwise_dist + max_anchor_negative_dist * ~anchor_negative_mask, dim=1)
+
+        ctx.squared = squared
+        ctx.normalized = normalized
+        ctx.save_for_backward(embeddings, positive_indices, negative_indices, hardest_positive_dist,
+                              hardest_negative_dist)
+        return hardest_positive_dist, hardest_negative_dist
+
+    @staticmethod
+    def backward(ctx, grad_positive, grad_negative):
+        embeddings, positive_indices, negative_indices, hardest_positive_dist, hardest_negative_dist = \
+            ctx.saved_tensors
+        grad = torch.zeros_like(embeddings)
+        for indices, dist, grad_dist in ((positive_indices, hardest_positive_dist, grad_positive),
+                                         (negative_indices, hardest_negative_dist, grad_negative)):
+            # d(a, b) / d a = 2 (a - b) if squared else (a - b) / d(a, b), zero distances get no gradient
+            # as in pairwise_distance (relu / sqrt mask). normalized: d^2 = 2 - 2 a.b, d(d^2) / d a = -2 b
+            if ctx.squared:
+                coef = 2 * grad_dist
+            else:
+                coef = grad_dist / dist.clamp(min=1e-16)
+            coef = (coef * torch.gt(dist, 0).to(coef.dtype)).unsqueeze(1)
+            if ctx.normalized:
+                grad -= coef * embeddings[indices]
+                grad.index_add_(0, indices, -coef * embeddings)
+            else:
+                pair_grad = coef * (embeddings - embeddings[indices])
+                grad += pair_grad
+                grad.index_add_(0, indices, -pair_grad)
+        return grad, None, None, None, None
+
+
+class FusedBatchHardTripletLoss(BatchHardTripletLoss):
+    """
+    batch hard triplet loss with the in-batch mining done by BatchHardDistance.
+    same loss and gradient as BatchHardTripletLoss, activation memory for backward is O(batch_size x embed_dim).
+    """
+    def hardest_dist(self, batch):
+        hardest_positive_dist, hardest_negative_dist = BatchHardDistance.apply(
+            batch.embeddings, batch.masks.anchor_positive, batch.masks.anchor_negative, self.squared,
+            batch.normalized)
+        return hardest_positive_dist.unsqueeze(1), hardest_negative_dist.unsqueeze(1)
+
+
+class BatchAllTripletLoss(PairwiseLoss):
     """
     batch all triplet loss
     """
-    def __init__(self, margin=0.1, squared=False, soft_margin=True):
+    def __init__(self, margin=0.1, squared=False, soft_margin=True, memory=None):
         """
         :param margin: margin for triplet loss
         :param squared: if True, output is the pairwise squared euclidean distance matrix.
                         if False, output is the pairwise euclidean distance matrix.
+        :param memory: optional EmbeddingMemory, positives and negatives are also taken from it
         """
         super(BatchAllTripletLoss, self).__init__()
         self.margin = margin
         self.squared = squared
         self.soft_margin = soft_margin
-
-    def forward(self, embeddings, labels):
-        """
-
-        :param embeddings: tensor of shape (batch_size, embed_dim)
-        :param labels: tensor of shape (batch_size, )
-        :return: triplet_loss and number of triplets
-        """
-
-        pairwise_dist = pairwise_distance(embeddings, squared=self.squared)
+        self.memory = memory
+
+    def _memory_forward(self, embeddings, labels, pairwise_dist, memory_budget=2 ** 22):
+        # anchors from the batch, positives and negatives from batch + memory, without the 3D tensor
+        memory_embeddings, memory_labels = self.memory.get()
+        memory_dist = cross_distance(embeddings, memory_embeddings, squared=self.squared, normalized=self.normalized)
+        candidate_dist = torch.cat((pairwise_dist, memory_dist), dim=1)
+        triplet_loss, num_hard_triplets = blocked_batch_all_triplet_loss(
+            candidate_dist, labels, margin=self.margin, soft_margin=self.soft_margin, memory_budget=memory_budget,
+            candidate_labels=torch.cat((labels, memory_labels)))
+        self.memory.enqueue(embeddings, labels)
+        return triplet_loss / (num_hard_triplets + 1e-16), num_hard_triplets
+
+    def forward_batch(self, batch):
+        embeddings, labels, masks = batch.embeddings, batch.labels, batch.masks
+        pairwise_dist = batch.distance(self.squared)
+
+        if self.memory is not None and len(self.memory) > 0:
+            return self._memory_forward(embeddings, labels, pairwise_dist)
+        elif self.memory is not None:
+            self.memory.enqueue(embeddings, labels)
 
         # shape (batch_size, batch_size, 1)
         anchor_positive_dist = pairwise_dist.unsqueeze(dim=2)
@@ -139,7 +363,7 @@ class BatchAllTripletLoss(nn.Module):
         assert anchor_negative_dist.shape[1] == 1, "{}".format(anchor_negative_dist.shape)
 
         # put to zero the invalid triplets
-        mask = get_triplet_mask(labels).float()
+        mask = masks.triplet.float()
 
         # Compute a 3D tensor of size(batch_size, batch_size, batch_size)
         # triplet_loss[i, j, k] will contain the triplet loss of anchor=i, pos=j, neg=k
@@ -169,106 +393,231 @@ class BatchAllTripletLoss(nn.Module):
         return triplet_loss, num_hard_triplets
 
 
-class BatchAllWithOutlierTripletLoss(nn.Module):
-    def __init__(self, margin=1.0, squared=False, kernel_width=None):
-        super(BatchAllWithOutlierTripletLoss, self).__init__()
+class BlockedBatchAllTripletLoss(BatchAllTripletLoss):
+    """
+    batch all triplet loss without the (batch_size, batch_size, batch_size) tensor.
+    same loss and number of hard triplets as BatchAllTripletLoss, peak memory is O(batch_size^2 + memory_budget).
+    """
+    def __init__(self, margin=0.1, squared=False, soft_margin=True, memory_budget=2 ** 22, memory=None):
+        """
+        :param margin: margin for triplet loss
+        :param squared: if True, output is the pairwise squared euclidean distance matrix.
+                        if False, output is the pairwise euclidean distance matrix.
+        :param memory_budget: max number of (anchor, positive, negative) elements computed at once
+        :param memory: optional EmbeddingMemory, positives and negatives are also taken from it
+        """
+        super(BlockedBatchAllTripletLoss, self).__init__(margin=margin, squared=squared, soft_margin=soft_margin,
+                                                         memory=memory)
+        self.memory_budget = memory_budget
+
+    def forward_batch(self, batch):
+        embeddings, labels = batch.embeddings, batch.labels
+        pairwise_dist = batch.distance(self.squared)
+        if self.memory is not None and len(self.memory) > 0:
+            return self._memory_forward(embeddings, labels, pairwise_dist, memory_budget=self.memory_budget)
+        elif self.memory is not None:
+            self.memory.enqueue(embeddings, labels)
+
+        triplet_loss, num_hard_triplets = blocked_batch_all_triplet_loss(pairwise_dist, labels, margin=self.margin,
+                                                                         soft_margin=self.soft_margin,
+                                                                         memory_budget=self.memory_budget)
+        triplet_loss = triplet_loss / (num_hard_triplets + 1e-16)
+        return triplet_loss, num_hard_triplets
 
+
+class ProxyLoss(nn.Module):
+    """
+    base class of proxy-based losses, one learnable proxy per class in the embedding space.
+    samples are compared to the n_classes proxies only, cost is O(batch_size x n_classes) and any batch composition
+    works, no balanced batch sampler needed. proxies are parameters, add loss_fn.parameters() to the optimizer.
+    """
+    def __init__(self, n_classes=10, embed_dim=64):
+        super(ProxyLoss, self).__init__()
+        self.n_classes = n_classes
+        self.embed_dim = embed_dim
+        self.proxies = nn.Parameter(torch.randn(n_classes, embed_dim) / embed_dim ** 0.5)
+
+
+class ProxyNCALoss(ProxyLoss):
+    """
+    Proxy-NCA loss, softmax over negative distances of a sample to all proxies, target is the proxy of its class.
+    """
+    def __init__(self, margin=0.0, squared=True, n_classes=10, embed_dim=64, normalize=True):
+        """
+        :param margin: added to the distance to the own class proxy
+        :param squared: if True, squared euclidean distance to proxies is used
+        :param n_classes:
+        :param embed_dim:
+        :param normalize: if True, embeddings and proxies are l2 normalized before the distances
+        """
+        super(ProxyNCALoss, self).__init__(n_classes=n_classes, embed_dim=embed_dim)
         self.margin = margin
         self.squared = squared
-        # beta == 1. / delta ** 2
-        self.kernel_width = kernel_width
+        self.normalize = normalize
 
     def forward(self, embeddings, labels):
         """
-
         :param embeddings: tensor of shape (batch_size, embed_dim)
-        :param labels: tensor of shape (batch_size, )
-        :return: triplet_loss and number of triplets
+        :param labels: tensor of shape (batch_size, ), values in [0, n_classes)
+        :return: loss and number of samples whose own proxy is not the nearest by margin
         """
+        proxies = self.proxies
+        if self.normalize:
+            embeddings = F.normalize(embeddings, dim=1)
+            proxies = F.normalize(proxies, dim=1)
+        # (batch_size, n_classes)
+        proxy_dist = cross_distance(embeddings, proxies, squared=self.squared)
+        positive_mask = F.one_hot(labels, self.n_classes).bool()
+        proxy_dist = proxy_dist + self.margin * positive_mask.float()
 
-        pairwise_dist = pairwise_distance(embeddings, squared=self.squared)
+        loss = F.cross_entropy(-proxy_dist, labels)
 
         with torch.no_grad():
-            if self.kernel_width is None:
-                delta, _ = pairwise_dist.topk(k=8, dim=1, largest=False)
-                gamma = 1 / 2 * (delta[:, -1] ** 2 + 1e-16)
-                # gaussian kernel, pairwise similarities
-                kernel_matrix = torch.exp(- torch.mul(pairwise_dist ** 2, gamma.view(-1, 1)))
-            else:
-                gamma = 1 / 2 * (self.kernel_width ** 2 + 1e-16)
-                # gaussian kernel, pairwise similarities
-                kernel_matrix = torch.exp(- torch.mul(pairwise_dist ** 2, gamma))
+            positive_dist = proxy_dist[positive_mask]
+            negative_dist, _ = torch.min(proxy_dist.masked_fill(positive_mask, float('inf')), dim=1)
+            num_hard = torch.sum(torch.ge(positive_dist, negative_dist).float())
+        return loss, num_hard
 
-            anchor_negative_mask = get_anchor_negative_triplet_mask(labels=labels).float()
-            # (batch_size,), sum over anchor-negative similarities
-            sum_neg = torch.sum(kernel_matrix * anchor_negative_mask, dim=1)
-            sum_all = torch.sum(kernel_matrix, dim=1) - kernel_matrix.diag()
-            # (batch_size,), ratio between anchor-negative distances and all distances for each anchor
-            outlier_prob = sum_neg / (sum_all + 1e-16)
-            outlier_prob.clamp_(min=1e-16, max=1-1e-16)
 
-            # count outlier num
-            logging.info('outlier prob >0.6 num {:3.0f}'.format(torch.sum(torch.gt(outlier_prob, 0.6).float()).item()))
+class ProxyAnchorLoss(ProxyLoss):
+    """
+    Proxy-Anchor loss, every proxy is an anchor pulling the batch samples of its class and pushing the others,
+    on cosine similarity.
+    """
+    def __init__(self, margin=0.1, squared=False, n_classes=10, embed_dim=64, alpha=32.0):
+        """
+        :param margin: cosine similarity margin
+        :param squared: not used, cosine similarity, kept so all losses share the constructor of main_triplet
+        :param n_classes:
+        :param embed_dim:
+        :param alpha: scale of the similarities
+        """
+        super(ProxyAnchorLoss, self).__init__(n_classes=n_classes, embed_dim=embed_dim)
+        self.margin = margin
+        self.alpha = alpha
 
-            # (batch_size, 1, 1), ready for broadcasting
-            inlier_prob = (1 - outlier_prob).view(-1, 1, 1)
+    def forward(self, embeddings, labels):
+        """
+        :param embeddings: tensor of shape (batch_size, embed_dim)
+        :param labels: tensor of shape (batch_size, ), values in [0, n_classes)
+        :return: loss and number of (sample, proxy) pairs violating the margin
+        """
+        # (batch_size, n_classes)
+        cos = torch.matmul(F.normalize(embeddings, dim=1), F.normalize(self.proxies, dim=1).t())
+        positive_mask = F.one_hot(labels, self.n_classes).float()
+        negative_mask = 1.0 - positive_mask
 
-        # shape (batch_size, batch_size, 1)
-        anchor_positive_dist = pairwise_dist.unsqueeze(dim=2)
-        assert anchor_positive_dist.shape[2] == 1, "{}".format(anchor_positive_dist.shape)
-        # shape (batch_size, 1, batch_size)
-        anchor_negative_dist = pairwise_dist.unsqueeze(dim=1)
-        assert anchor_negative_dist.shape[1] == 1, "{}".format(anchor_negative_dist.shape)
+        positive_exp = torch.exp(-self.alpha * (cos - self.margin)) * positive_mask
+        negative_exp = torch.exp(self.alpha * (cos + self.margin)) * negative_mask
 
-        # Compute a 3D tensor of size(batch_size, batch_size, batch_size)
-        # triplet_loss[i, j, k] will contain the triplet loss of anchor=i, pos=j, neg=k
-        # Uses broadcasting where the 1st argument has shape(batch_size, batch_size, 1)
-        # and the 2nd (batch_size, 1, batch_size)
-        triplet_loss = anchor_positive_dist - anchor_negative_dist + self.margin
+        # proxies with at least one positive sample in the batch
+        with_positive = torch.gt(positive_mask.sum(dim=0), 0)
+        num_valid_proxies = torch.sum(with_positive.float())
+        positive_term = torch.sum(torch.log1p(positive_exp.sum(dim=0))[with_positive]) / (num_valid_proxies + 1e-16)
+        negative_term = torch.sum(torch.log1p(negative_exp.sum(dim=0))) / self.n_classes
 
-        # put to zero the invalid triplets
-        mask = get_triplet_mask(labels).float()
-        triplet_loss = triplet_loss * mask
+        with torch.no_grad():
+            violations = torch.lt(cos, self.margin).float() * positive_mask + \
+                         torch.gt(cos, -self.margin).float() * negative_mask
+            num_hard = torch.sum(violations)
+        return positive_term + negative_term, num_hard
 
-        # remove negative losses (i.e. the easy triplets)
-        triplet_loss = F.relu(triplet_loss)
 
-        # count number of hard triplets (where triplet_loss > 0)
-        hard_triplets = torch.gt(triplet_loss, 1e-16).float()
-        num_hard_triplets = torch.sum(hard_triplets)
-        assert num_hard_triplets > 1e-16
+class BatchAllWithOutlierTripletLoss(PairwiseLoss):
+    """
+    batch all triplet loss, the loss of each anchor is weighted by its inlier probability.
+    no host-device sync inside forward: the number of outliers is returned as a third output on the device, report it
+    with AverageOutlierMetric. triplets are evaluated with the memory-bounded batch-all path.
+    """
+    def __init__(self, margin=1.0, squared=False, kernel_width=None, outlier_threshold=0.6, memory_budget=2 ** 22):
+        """
+        :param margin: margin for triplet loss
+        :param squared: if True, output is the pairwise squared euclidean distance matrix.
+        :param kernel_width: gaussian kernel width, None for a per-anchor width (distance to the 8th nearest sample)
+        :param outlier_threshold: anchors with outlier probability above it are counted as outliers
+        :param memory_budget: max number of (anchor, positive, negative) elements computed at once
+        """
+        super(BatchAllWithOutlierTripletLoss, self).__init__()
 
-        triplet_loss = torch.sum(triplet_loss * inlier_prob) / (num_hard_triplets + 1e-16)
-        return triplet_loss, num_hard_triplets
+        self.margin = margin
+        self.squared = squared
+        # beta == 1. / delta ** 2
+        self.kernel_width = kernel_width
+        self.outlier_threshold = outlier_threshold
+        self.memory_budget = memory_budget
+
+    def inlier_prob(self, kernel_matrix, anchor_negative_mask):
+        """
+        inlier probability of each anchor, 1 - (kernel similarity to negatives / kernel similarity to all others).
+        :param kernel_matrix: gaussian kernel of pairwise distances, tensor of shape (batch_size, batch_size)
+        :param anchor_negative_mask: bool tensor of shape (batch_size, batch_size)
+        :return: inlier probability (batch_size, ) and number of outliers (0-dim tensor)
+        """
+        sum_all = torch.sum(kernel_matrix, dim=1) - kernel_matrix.diagonal()
+        # (batch_size,), sum over anchor-negative similarities
+        sum_neg = torch.sum(kernel_matrix * anchor_negative_mask, dim=1)
+        # (batch_size,), ratio between anchor-negative similarities and all similarities for each anchor
+        outlier_prob = (sum_neg / (sum_all + 1e-16)).clamp_(min=1e-16, max=1 - 1e-16)
+        num_outliers = torch.sum(torch.gt(outlier_prob, self.outlier_threshold))
+        return 1 - outlier_prob, num_outliers
+
+    def forward_batch(self, batch):
+        # outputs: triplet_loss, number of triplets and number of outlier anchors
+        labels = batch.labels
+        pairwise_dist = batch.distance(self.squared)
+
+        with torch.no_grad():
+            inlier_prob, num_outliers = self.inlier_prob(batch.kernel(self.squared, self.kernel_width),
+                                                         batch.masks.anchor_negative)
 
+        triplet_loss, num_hard_triplets = blocked_batch_all_triplet_loss(
+            pairwise_dist, labels, margin=self.margin, anchor_weights=inlier_prob, memory_budget=self.memory_budget)
+        triplet_loss = triplet_loss / (num_hard_triplets + 1e-16)
+        return triplet_loss, num_hard_triplets, num_outliers
 
-class LargeMarginLoss(nn.Module):
+
+class LargeMarginLoss(PairwiseLoss):
     """
-    Better to use large batch size
+    Better to use large batch size, or a cross-batch memory
     """
-    def __init__(self, margin=1.0, squared=False, kernel_width=1.0):
+    def __init__(self, margin=1.0, squared=False, kernel_width=1.0, memory=None):
         super(LargeMarginLoss, self).__init__()
         self.margin = margin
         self.squared = squared
         # beta == 1. / delta ** 2
         self.kernel_width = kernel_width
-
-    def forward(self, embeddings, labels):
-        pairwise_dist = pairwise_distance(embeddings, squared=self.squared)
+        # optional EmbeddingMemory, nearest positive/negative probabilities also cover it
+        self.memory = memory
+
+    def forward_batch(self, batch):
+        embeddings, labels, masks = batch.embeddings, batch.labels, batch.masks
+        pairwise_dist = batch.distance(self.squared)
+        anchor_positive_mask = masks.anchor_positive  # BoolTensor
+        anchor_negative_mask = masks.anchor_negative
+
+        if self.memory is not None and len(self.memory) > 0:
+            # (batch_size, batch_size + memory_size)
+            memory_embeddings, memory_labels = self.memory.get()
+            memory_positive_mask = torch.eq(labels.unsqueeze(1), memory_labels.unsqueeze(0))
+            pairwise_dist = torch.cat((pairwise_dist,
+                                       cross_distance(embeddings, memory_embeddings, squared=self.squared,
+                                                      normalized=self.normalized)), dim=1)
+            anchor_positive_mask = torch.cat((anchor_positive_mask, memory_positive_mask), dim=1)
+            anchor_negative_mask = torch.cat((anchor_negative_mask, ~memory_positive_mask), dim=1)
+        if self.memory is not None:
+            self.memory.enqueue(embeddings, labels)
 
         with torch.no_grad():
             gamma = 1 / 2 * (self.kernel_width ** 2 + 1e-16)
 
             # calc nearest positive probability
             gamma_pairwise_dist = torch.mul(pairwise_dist, - gamma)
-            anchor_positive_mask = get_anchor_positive_triplet_mask(labels)  # ByteTensor
-            gamma_pairwise_dist.masked_fill_(anchor_positive_mask ^ 1, float('-inf'))
+            gamma_pairwise_dist.masked_fill_(~anchor_positive_mask, float('-inf'))
             nearest_positive_prob = F.softmax(gamma_pairwise_dist, dim=1)
 
             # nearest negative probability
             gamma_pairwise_dist2 = torch.mul(pairwise_dist, - gamma)
-            anchor_negative_mask = get_anchor_negative_triplet_mask(labels)
-            gamma_pairwise_dist2.masked_fill_(anchor_negative_mask ^ 1, float('-inf'))
+            gamma_pairwise_dist2.masked_fill_(~anchor_negative_mask, float('-inf'))
             nearest_negative_prob = F.softmax(gamma_pairwise_dist2, dim=1)
 
         # (batch_size, )
@@ -282,3 +631,93 @@ class LargeMarginLoss(nn.Module):
         hard_triplets = torch.gt(hinge_loss, 1e-16).float()
         num_hard_triplets = torch.sum(hard_triplets)
         return torch.mean(hinge_loss), num_hard_triplets
+
+
+class CrossEntropyHeadLoss(nn.Module):
+    """
+    cross entropy of a classification head on the embeddings, e.g. nn.Sequential(nn.ReLU(), model.cls) for
+    vggish_bn, so a classification objective can be combined with metric losses in CompositeLoss.
+    """
+    def __init__(self, head):
+        super(CrossEntropyHeadLoss, self).__init__()
+        self.head = head
+
+    def forward(self, embeddings, labels):
+        """
+        :param embeddings: tensor of shape (batch_size, embed_dim)
+        :param labels: tensor of shape (batch_size, )
+        :return: loss and number of misclassified samples
+        """
+        logits = self.head(embeddings)
+        loss = F.cross_entropy(logits, labels)
+        with torch.no_grad():
+            num_errors = torch.sum(torch.ne(logits.argmax(dim=1), labels).float())
+        return loss, num_errors
+
+
+class CompositeLoss(nn.Module):
+    """
+    weighted sum of several losses on the same batch. pairwise distances (squared and not), label masks and kernels
+    are computed once in a PairwiseBatch and shared by every PairwiseLoss member, other members get the raw batch.
+    """
+    def __init__(self, losses, weights=None):
+        """
+        :param losses: list of loss modules
+        :param weights: list of floats, default all 1
+        """
+        super(CompositeLoss, self).__init__()
+        self.losses = nn.ModuleList(losses)
+        self.weights = list(weights) if weights is not None else [1.0] * len(losses)
+        self.normalized = False
+        assert len(self.weights) == len(self.losses)
+
+    def set_normalized(self, normalized):
+        self.normalized = normalized
+        for loss_fn in self.losses:
+            if isinstance(loss_fn, PairwiseLoss):
+                loss_fn.set_normalized(normalized)
+        return self
+
+    def forward(self, embeddings, labels):
+        """
+        :param embeddings: tensor of shape (batch_size, embed_dim)
+        :param labels: tensor of shape (batch_size, )
+        :return: weighted loss, second output of the first member (number of triplets for triplet losses) and a
+                 tuple with the outputs of every member
+        """
+        batch = PairwiseBatch(embeddings, labels, normalized=self.normalized)
+        member_outputs = []
+        total_loss = 0
+        for loss_fn, weight in zip(self.losses, self.weights):
+            if isinstance(loss_fn, PairwiseLoss):
+                outputs = loss_fn.forward_batch(batch)
+            else:
+                outputs = loss_fn(embeddings, labels)
+            outputs = outputs if type(outputs) in (tuple, list) else (outputs,)
+            total_loss = total_loss + weight * outputs[0]
+            member_outputs.append(outputs)
+        first = member_outputs[0][1] if len(member_outputs[0]) > 1 else total_loss.detach()
+        return total_loss, first, tuple(member_outputs)
+
+
+if __name__ == '__main__':
+    # FusedBatchHardTripletLoss against BatchHardTripletLoss: gradcheck of the custom backward, then same loss and
+    # gradient on a random batch
+    torch.manual_seed(0)
+    for squared in (False, True):
+        embeddings = torch.randn(24, 8, dtype=torch.float64, requires_grad=True)
+        labels = torch.arange(24) % 4
+        _, _, masks = mask_provider(embeddings, labels)
+        assert torch.autograd.gradcheck(lambda e: BatchHardDistance.apply(e, masks.anchor_positive,
+                                                                          masks.anchor_negative, squared),
+                                        (embeddings.detach()[torch.argsort(labels, stable=True)].requires_grad_(),))
+        for soft_margin in (False, True):
+            loss, num = BatchHardTripletLoss(margin=0.5, squared=squared, soft_margin=soft_margin)(embeddings, labels)
+            grad, = torch.autograd.grad(loss, embeddings)
+            fused_loss, fused_num = FusedBatchHardTripletLoss(margin=0.5, squared=squared,
+                                                              soft_margin=soft_margin)(embeddings, labels)
+            fused_grad, = torch.autograd.grad(fused_loss, embeddings)
+            assert torch.allclose(loss, fused_loss) and torch.equal(num, fused_num)
+            assert torch.allclose(grad, fused_grad)
+            print('squared={}, soft_margin={}: loss {:.6f}, max grad diff {:.3e}'.format(
+                squared, soft_margin, loss.item(), (grad - fused_grad).abs().max().item()))
@@ -63,4 +63,64 @@ class AverageNoneZeroTripletsMetric(Metric):
         return np.mean(self.values)
 
     def name(self):
-        return 'nonzeros'
\ No newline at end of file
+        return 'nonzeros'
+
+
+class AverageOutlierMetric(Metric):
+    """
+    Average number of outlier anchors per minibatch, from the third output of BatchAllWithOutlierTripletLoss.
+    counts are summed on the loss device, the value is only fetched when reported.
+    """
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def __call__(self, outputs, target, loss):
+        if len(loss) > 2 and hasattr(loss[2], 'detach'):
+            self.total = self.total + loss[2].detach()
+            self.count += 1
+        # no self.value() here, it would sync with the device every step
+        return self.total
+
+    def reset(self):
+        self.total = 0
+        self.count = 0
+
+    def value(self):
+        return float(self.total) / max(self.count, 1)
+
+    def name(self):
+        return 'outliers'
+
+
+class CompositeMemberMetric(Metric):
+    """
+    Average loss (or another output) of one member of a CompositeLoss, summed on the device like
+    AverageOutlierMetric.
+    """
+    def __init__(self, member, output=0, name=None):
+        """
+        :param member: index of the member in CompositeLoss.losses
+        :param output: index in the outputs of that member, 0 is its loss
+        :param name: metric name, default 'member{member}_{output}'
+        """
+        self.member = member
+        self.output = output
+        self._name = name if name else 'member{}_{}'.format(member, output)
+        self.total = 0
+        self.count = 0
+
+    def __call__(self, outputs, target, loss):
+        self.total = self.total + loss[2][self.member][self.output].detach()
+        self.count += 1
+        return self.total
+
+    def reset(self):
+        self.total = 0
+        self.count = 0
+
+    def value(self):
+        return float(self.total) / max(self.count, 1)
+
+    def name(self):
+        return self._name
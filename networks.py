@@ -7,6 +7,25 @@ import torch.nn.functional as F
 import torch
 
 
+def _l2_normalize_hook(module, inputs, output):
+    return F.normalize(output, p=2, dim=1)
+
+
+def l2_normalized(model):
+    """
+    make the network output unit-length embeddings, in forward and get_embeddings. distances between embeddings are
+    then given by their dot products, see normalized=True in utils.utilities.pairwise_distance.
+    a forward hook is used, so the state_dict and saved checkpoints are unchanged, model.normalized marks the model
+    (see utils.embedding_store). get_embeddings must go through model(x) for the hook to apply. call it after the
+    classification pretraining, the logits of vggish_bn(classify=True) would be normalized too.
+    :param model:
+    :return: the same model
+    """
+    model.register_forward_hook(_l2_normalize_hook)
+    model.normalized = True
+    return model
+
+
 # TODO better network(cnn and lstm)
 class vggish_bn(nn.Module):
 
@@ -99,7 +118,8 @@ class vggish_bn(nn.Module):
         return x
 
     def get_embeddings(self, x):
-        return self.forward(x)
+        # through __call__, so forward hooks (e.g. l2_normalized) apply to embeddings too
+        return self(x)
 
     def set_classify(self, classifiy):
         self.classify = classifiy
@@ -145,7 +165,8 @@ class embedding_net_shallow(nn.Module):
         return torch.mean(out, dim=1)
 
     def get_embeddings(self, x):
-        return self.forward(x)
+        # through __call__, so forward hooks (e.g. l2_normalized) apply to embeddings too
+        return self(x)
 
 
 class classifier(nn.Module):
@@ -199,6 +220,15 @@ class CRNN(nn.Module):
         return x
 
     def get_embeddings(self, x):
-        return self.forward(x)
-
-
+        # through __call__, so forward hooks (e.g. l2_normalized) apply to embeddings too
+        return self(x)
+
+
+if __name__ == '__main__':
+    # embeddings of an l2_normalized model are unit length, in forward and get_embeddings
+    net = l2_normalized(embedding_net_shallow()).eval()
+    x = torch.randn(4, 1, 40, 500)
+    with torch.no_grad():
+        for out in (net(x), net.get_embeddings(x)):
+            assert torch.allclose(out.norm(dim=1), torch.ones(len(out)), atol=1e-5), out.norm(dim=1)
+    print('l2_normalized get_embeddings unit norm: ok')
@@ -25,7 +25,7 @@ def fit(train_loader, val_loader, model, loss_fn, optimizer, scheduler, n_epochs
         scheduler.step()
 
         # train stage
-        train_loss, metrics = train_epoch(train_loader, model, loss_fn, optimizer, log_interval, metrics)
+        train_loss, metrics = train_epoch(train_loader, model, loss_fn, optimizer, log_interval, metrics, epoch=epoch)
         train_logs = dict()
         train_logs['loss'] = train_loss
         for metric in metrics:
@@ -82,10 +82,22 @@ def fit(train_loader, val_loader, model, loss_fn, optimizer, scheduler, n_epochs
                 ckpter.check_on(epoch=epoch, monitor='acc', loss_acc=val_hist.recent)
 
 
-def train_epoch(train_loader, model, loss_fn, optimizer, log_interval, metrics):
+def train_epoch(train_loader, model, loss_fn, optimizer, log_interval, metrics, ckpter=None, epoch=None,
+                save_interval=0, start_step=0):
+    """
+    train one epoch.
+    :param ckpter: CheckPoint, if given with save_interval > 0, a resume checkpoint is written every save_interval steps
+    :param epoch: current epoch, stored in the resume checkpoint and passed to set_epoch() of the dataset (e.g.
+    TripletDevSet draws new triplets)
+    :param save_interval:
+    :param start_step: batches of this epoch already trained before a resume, the sampler skips them
+    :return: average loss and metrics
+    """
     for metric in metrics:
         metric.reset()
 
+    if epoch is not None and hasattr(train_loader.dataset, 'set_epoch'):
+        train_loader.dataset.set_epoch(epoch)
     model.train()
     losses = []
     total_loss = 0
@@ -116,6 +128,9 @@ def train_epoch(train_loader, model, loss_fn, optimizer, log_interval, metrics):
         loss.backward()
         optimizer.step()
 
+        if ckpter is not None and save_interval > 0 and (start_step + batch_idx + 1) % save_interval == 0:
+            ckpter.save_resume(epoch=epoch, step=start_step + batch_idx + 1)
+
         for metric in metrics:
             metric(outputs, target, loss_outputs)
 
@@ -9,10 +9,15 @@ class CheckPoint(object):
     Bind model and optimizer
     """
 
-    def __init__(self, model=None, optimizer=None, path=None, prefix="", interval=5, save_num=3, verbose=True):
+    def __init__(self, model=None, optimizer=None, path=None, prefix="", interval=5, save_num=3, verbose=True,
+                 sampler=None, loss_fn=None):
         self.verbose = verbose
         self.model = model
         self.optimizer = optimizer
+        # loss module with learnable state (e.g. class proxies), saved and restored along with the model
+        self.loss_fn = loss_fn
+        # batch sampler with state_dict/load_state_dict, saved for exact mid-epoch resume
+        self.sampler = sampler
         self.path = path
         self.prefix = prefix
         self.interval = interval
@@ -31,6 +36,20 @@ class CheckPoint(object):
                                                                                   epoch, monitor, loss_acc[monitor]))
         return full_path
 
+    def _state(self, epoch, step=None):
+        return {
+            'epoch': epoch,
+            'step': step,
+            'model_state_dict': self.model.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict() if self.optimizer else None,
+            'loss_state_dict': self.loss_fn.state_dict() if self.loss_fn is not None else None,
+            'rng_state': torch.cuda.get_rng_state() if torch.cuda.is_available() else None,
+            'cpu_rng_state': torch.get_rng_state(),
+            'np_rng_state': np.random.get_state(),
+            'sampler_state': self.sampler.state_dict(step) if self.sampler is not None else None,
+            'histories': self.histories,
+        }
+
     def save(self, epoch, monitor, loss_acc, save_path=None):
         """
         save a checkpoint
@@ -41,16 +60,52 @@ class CheckPoint(object):
         :return:
         """
         full_path = save_path if save_path else self._get_save_path(epoch, monitor, loss_acc)
-        torch.save({
-            'epoch': epoch,
-            'model_state_dict': self.model.state_dict(),
-            'optimizer_state_dict': self.optimizer.state_dict() if self.optimizer else None,
-            'rng_state': torch.cuda.get_rng_state(),
-            'histories': self.histories,
-            monitor: loss_acc[monitor]
-        }, full_path)
+        state = self._state(epoch)
+        state[monitor] = loss_acc[monitor]
+        torch.save(state, full_path)
         print('[CheckPoint:]saved model to', full_path) if self.verbose else None
 
+    def resume_path(self):
+        # not a .tar file, so Reporter.select_best never picks it up
+        return os.path.join(self.path, '{},{},resume.pth'.format(self.prefix, type(self.model).__name__))
+
+    def save_resume(self, epoch, step=None):
+        """
+        overwrite the resume checkpoint of this run.
+        :param epoch: current epoch
+        :param step: number of batches of the epoch already trained, None if the epoch is finished
+        :return:
+        """
+        full_path = self.resume_path()
+        torch.save(self._state(epoch, step), full_path + '.tmp')
+        os.replace(full_path + '.tmp', full_path)
+
+    def load_resume(self, path=None):
+        """
+        restore model, optimizer, random generators, sampler and histories from a resume checkpoint.
+        :param path: default is resume_path()
+        :return: (epoch, step) to continue from, step is the number of batches of that epoch to skip
+        """
+        # the resume state holds numpy rng states and History objects, not only tensors
+        state = torch.load(path if path else self.resume_path(), weights_only=False)
+        self.model.load_state_dict(state['model_state_dict'])
+        if self.optimizer and state['optimizer_state_dict'] is not None:
+            self.optimizer.load_state_dict(state['optimizer_state_dict'])
+        if self.loss_fn is not None and state.get('loss_state_dict') is not None:
+            self.loss_fn.load_state_dict(state['loss_state_dict'])
+        if state['rng_state'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state(state['rng_state'])
+        torch.set_rng_state(state['cpu_rng_state'])
+        np.random.set_state(state['np_rng_state'])
+        if self.sampler is not None and state['sampler_state'] is not None:
+            self.sampler.load_state_dict(state['sampler_state'])
+        if state.get('histories'):
+            self._restore_histories(state['histories'])
+        print('[CheckPoint:]resumed from', path if path else self.resume_path()) if self.verbose else None
+        if state['step'] is None:
+            return state['epoch'] + 1, 0
+        return state['epoch'], state['step']
+
     def _delete_and_save(self, epoch, monitor, loss_acc, delete_idx):
         """
         delete old saved checkpoint and save new.
@@ -81,6 +136,15 @@ class CheckPoint(object):
 
         self.histories = hist_list
 
+    def _restore_histories(self, saved):
+        # refill the bound History objects in place by name, the training script keeps its references to them
+        saved = {hist.name: hist for hist in saved}
+        for hist in self.histories or []:
+            if hist.name in saved:
+                axes = hist.axes
+                hist.__dict__.update(saved[hist.name].__dict__)
+                hist.axes = axes
+
     def bind_histories(self, hist_list=None):
         if hist_list:
             self.histories = hist_list
@@ -0,0 +1,130 @@
+import numpy as np
+from utils.utilities import knn_search, knn_vote
+from utils.gallery import kmeans
+
+"""
+gallery condensation: shrink the kNN reference set of stored embeddings (see utils.embedding_store) to a small
+prototype set, and measure the accuracy cost. every method returns the reduced gallery as (embeddings, labels).
+"""
+
+
+def kmeans_prototypes(embeddings, labels, per_class=10, n_iter=20, seed=0):
+    """
+    per-class k-means centroids.
+    :param embeddings: numpy of shape (n_samples, dims)
+    :param labels: numpy of shape (n_samples, )
+    :param per_class: centroids of every class, at most its number of samples
+    :param n_iter: k-means iterations
+    :param seed:
+    :return: prototypes (n_classes x per_class, dims) float32 and their labels
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    labels = np.asarray(labels, dtype=np.int64)
+    prototypes, prototype_labels = [], []
+    for label in np.unique(labels):
+        centroids, _ = kmeans(embeddings[labels == label], per_class, n_iter=n_iter, seed=seed)
+        prototypes.append(centroids)
+        prototype_labels.append(np.full(len(centroids), label, dtype=np.int64))
+    return np.concatenate(prototypes), np.concatenate(prototype_labels)
+
+
+def edited_nn(embeddings, labels, k=3, cls_num=10, block_size=1024):
+    """
+    Wilson's edited nearest neighbour: drop every sample misclassified by the vote of its k nearest other samples.
+    removes label noise and class overlap, the gallery shrinks only a little.
+    :param embeddings: numpy of shape (n_samples, dims)
+    :param labels: numpy of shape (n_samples, )
+    :param k:
+    :param cls_num:
+    :param block_size: samples searched at once
+    :return: kept embeddings and labels
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    labels = np.asarray(labels, dtype=np.int64)
+    neighbours, _ = knn_search(embeddings, embeddings, k=k + 1, block_size=block_size)
+    # leave one out: drop the sample itself, or the farthest neighbour if a duplicate came first
+    is_self = neighbours == np.arange(len(labels)).reshape(-1, 1)
+    is_self[~is_self.any(axis=1), -1] = True
+    neighbours = neighbours[~is_self].reshape(len(labels), k)
+    keep = knn_vote(labels[neighbours], cls_num) == labels
+    return embeddings[keep], labels[keep]
+
+
+def condensed_nn(embeddings, labels, max_passes=10, batch_size=256, seed=0):
+    """
+    Hart's condensed nearest neighbour: start from one sample per class, add every sample the current set
+    misclassifies with 1-NN, until a pass adds nothing. samples are visited in random order and in batches of
+    batch_size (one search per batch), a batch adds all its misclassified samples at once.
+    :param embeddings: numpy of shape (n_samples, dims)
+    :param labels: numpy of shape (n_samples, )
+    :param max_passes:
+    :param batch_size: 1 is the original sequential algorithm
+    :param seed:
+    :return: kept embeddings and labels
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    labels = np.asarray(labels, dtype=np.int64)
+    random_state = np.random.RandomState(seed)
+    order = random_state.permutation(len(labels))
+    _, first = np.unique(labels[order], return_index=True)
+    kept = np.zeros(len(labels), dtype=bool)
+    kept[order[first]] = True
+
+    for _ in range(max_passes):
+        added = 0
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            batch = batch[~kept[batch]]
+            if len(batch) == 0:
+                continue
+            store = np.nonzero(kept)[0]
+            nearest, _ = knn_search(embeddings[batch], embeddings[store], k=1)
+            wrong = batch[labels[store[nearest[:, 0]]] != labels[batch]]
+            kept[wrong] = True
+            added += len(wrong)
+        if added == 0:
+            break
+        order = random_state.permutation(len(labels))
+    return embeddings[kept], labels[kept]
+
+
+def condensation_report(train_embedding, train_labels, test_embedding, test_labels, k=3, cls_num=10,
+                        per_class=(1, 5, 20, 50), block_size=1024):
+    """
+    kNN accuracy versus gallery size of the full gallery, ENN, CNN, ENN followed by CNN and per-class k-means.
+    galleries with less than k samples in some class are voted with k = that count (k-means with per_class < k).
+    :param train_embedding: gallery, numpy of shape (n_train, dims)
+    :param train_labels:
+    :param test_embedding: queries, numpy of shape (n_test, dims)
+    :param test_labels:
+    :param k:
+    :param cls_num:
+    :param per_class: k-means prototypes per class
+    :param block_size:
+    :return: list of dict with method, gallery size, k, size ratio and accuracy
+    """
+    train_embedding = np.asarray(train_embedding, dtype=np.float32)
+    train_labels = np.asarray(train_labels, dtype=np.int64)
+    test_embedding = np.asarray(test_embedding, dtype=np.float32)
+    test_labels = np.asarray(test_labels, dtype=np.int64)
+
+    edited = edited_nn(train_embedding, train_labels, k=k, cls_num=cls_num, block_size=block_size)
+    galleries = [('full', (train_embedding, train_labels)),
+                 ('enn', edited),
+                 ('cnn', condensed_nn(train_embedding, train_labels)),
+                 ('enn+cnn', condensed_nn(*edited))]
+    galleries += [('kmeans{}'.format(n), kmeans_prototypes(train_embedding, train_labels, per_class=n))
+                  for n in per_class]
+
+    report = []
+    for method, (gallery, gallery_labels) in galleries:
+        # with fewer than k prototypes per class the k votes split between classes
+        counts = np.bincount(gallery_labels)
+        k_vote = int(min(k, counts[counts > 0].min()))
+        neighbours, _ = knn_search(test_embedding, gallery, k=k_vote, block_size=block_size)
+        acc = np.mean(knn_vote(gallery_labels[neighbours], cls_num) == test_labels)
+        report.append({'method': method, 'size': len(gallery_labels), 'k': k_vote,
+                       'ratio': len(gallery_labels) / len(train_labels), 'acc': acc})
+        print('[Condensation:]{:9} {:7d} samples ({:.4f} of full), k={}, acc {:.4f}'.format(
+            method, len(gallery_labels), report[-1]['ratio'], k_vote, acc))
+    return report
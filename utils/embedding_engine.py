@@ -0,0 +1,118 @@
+import numpy as np
+import torch
+
+"""
+device-agnostic embedding extraction: runs a model over a DataLoader on cpu or gpu, without autograd bookkeeping,
+with the host to device copy of the next batch overlapping the forward pass of the current one. embeddings are
+written into one preallocated float32 tensor on the device and copied out once, or streamed in chunks to a
+memory-mapped .npy file.
+"""
+
+
+class EmbeddingEngine(object):
+    """
+    embedding extraction used by kNN, the classifier stage and XGBoost, see utils.utilities.extract_embeddings.
+    """
+    def __init__(self, device=None, num_threads=None, flush_rows=65536):
+        """
+        :param device: torch device, default the device of the model parameters
+        :param num_threads: intra-op threads of cpu inference, default unchanged
+        :param flush_rows: rows kept on the device before they are written to the memory-mapped file
+        """
+        self.device = None if device is None else torch.device(device)
+        self.num_threads = num_threads
+        self.flush_rows = flush_rows
+
+    def _model_device(self, model):
+        if self.device is not None:
+            return self.device
+        parameter = next(model.parameters(), None)
+        return parameter.device if parameter is not None else torch.device('cpu')
+
+    @staticmethod
+    def _device_batches(loader, device):
+        # yields (data on device, target on cpu), the copy of the next batch is issued before the current one is used
+        stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+        def to_device(batch):
+            data, target = batch
+            if stream is None:
+                return data.to(device), target
+            with torch.cuda.stream(stream):
+                return data.to(device, non_blocking=True), target
+
+        def ready(batch):
+            if stream is not None:
+                torch.cuda.current_stream(device).wait_stream(stream)
+                batch[0].record_stream(torch.cuda.current_stream(device))
+            return batch
+
+        iterator = iter(loader)
+        upcoming = next(iterator, None)
+        if upcoming is None:
+            return
+        upcoming = to_device(upcoming)
+        for batch in iterator:
+            current, upcoming = upcoming, to_device(batch)
+            yield ready(current)
+        yield ready(upcoming)
+
+    def extract(self, loader, model, k_dims=None, memmap_path=None):
+        """
+        :param loader: DataLoader iterating its dataset once in order, yielding (data, target)
+        :param model: network with get_embeddings
+        :param k_dims: embedding dims, default inferred from the first batch
+        :param memmap_path: optional .npy path, embeddings are streamed to it and returned memory mapped
+        :return: float32 numpy of shape (n_samples, k_dims), int64 numpy of shape (n_samples, )
+        """
+        device = self._model_device(model)
+        n = len(loader.dataset)
+        labels = np.zeros(n, dtype=np.int64)
+        output = None
+        stage = None
+        # rows [flushed, k) of the memmap output are still in the device stage
+        flushed = 0
+
+        num_threads = torch.get_num_threads()
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        training = model.training
+        model.eval()
+        try:
+            with torch.inference_mode():
+                k = 0
+                for data, target in self._device_batches(loader, device):
+                    embeddings = model.get_embeddings(data)
+                    if output is None:
+                        k_dims = k_dims or embeddings.size(1)
+                        if memmap_path is None:
+                            output = torch.empty(n, k_dims, dtype=torch.float32, device=device)
+                        else:
+                            output = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=np.float32,
+                                                               shape=(n, k_dims))
+                            stage = torch.empty(min(self.flush_rows, n), k_dims, dtype=torch.float32, device=device)
+                    size = len(embeddings)
+                    if stage is None:
+                        output[k:k + size] = embeddings
+                    else:
+                        if k + size - flushed > len(stage):
+                            output[flushed:k] = stage[:k - flushed].cpu().numpy()
+                            flushed = k
+                        if size > len(stage):
+                            output[k:k + size] = embeddings.cpu().numpy()
+                            flushed = k + size
+                        else:
+                            stage[k - flushed:k - flushed + size] = embeddings
+                    labels[k:k + size] = target.numpy()
+                    k += size
+        finally:
+            torch.set_num_threads(num_threads)
+            model.train(training)
+
+        if output is None:
+            return np.zeros([0, k_dims or 0], dtype=np.float32), labels
+        if stage is None:
+            return output.cpu().numpy(), labels
+        output[flushed:k] = stage[:k - flushed].cpu().numpy()
+        output.flush()
+        return output, labels
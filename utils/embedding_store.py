@@ -0,0 +1,178 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from utils.embedding_engine import EmbeddingEngine
+
+"""
+persistent embedding store: embeddings, labels and fname codes of a dataset under a model checkpoint, saved as .npy
+files and loaded memory mapped. entries are keyed by the checkpoint content, the dataset, the normalization
+scaler of its transform and the model output options (l2_normalized, forward hooks, k_dims), so classifier sweeps,
+XGBoost, t-SNE or EER runs after training skip the network.
+"""
+
+STORE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'asc_triplet', 'embeddings')
+
+
+def checkpoint_hash(checkpoint=None, model=None):
+    """
+    :param checkpoint: checkpoint file, hashed by content
+    :param model: hashed by its state_dict when no checkpoint file is given
+    :return: hex string
+    """
+    md5 = hashlib.md5()
+    if checkpoint is not None:
+        with open(checkpoint, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+    else:
+        for name, tensor in model.state_dict().items():
+            md5.update(name.encode())
+            md5.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return md5.hexdigest()
+
+
+def dataset_hash(dataset, n_rows=64):
+    """
+    identify a dataset by its type, length, labels, fname codes, data shape and dtype, and n_rows evenly spaced
+    data rows.
+    the data itself is not hashed entirely, it is usually a large (shared) memory map.
+    :param dataset:
+    :param n_rows:
+    :return: hex string
+    """
+    md5 = hashlib.md5()
+    md5.update('|'.join([type(dataset).__name__, str(len(dataset))]).encode())
+    labels = getattr(dataset, 'labels', None)
+    if labels is not None:
+        md5.update(np.ascontiguousarray(labels).tobytes())
+    fnames = getattr(dataset, 'fnames', None)
+    if fnames is not None:
+        md5.update(np.ascontiguousarray(fnames).tobytes())
+    data = getattr(dataset, 'data', None)
+    if data is not None:
+        md5.update('|'.join([str(getattr(data, 'shape', None)), str(getattr(data, 'dtype', None))]).encode())
+        for index in np.linspace(0, len(data) - 1, min(n_rows, len(data))).astype(np.int64):
+            md5.update(np.ascontiguousarray(data[index]).tobytes())
+    return md5.hexdigest()
+
+
+def scaler_hash(transform):
+    """
+    identify the transform pipeline by its class names and the mean and std of its scalers (e.g. Normalize).
+    :param transform: callable or torchvision Compose
+    :return: hex string
+    """
+    md5 = hashlib.md5()
+    for t in getattr(transform, 'transforms', [transform]):
+        md5.update(type(t).__name__.encode())
+        for attr in ('mean', 'std'):
+            if hasattr(t, attr):
+                md5.update(np.ascontiguousarray(getattr(t, attr), dtype=np.float64).tobytes())
+    return md5.hexdigest()
+
+
+def output_hash(model=None, k_dims=None, tag=None):
+    """
+    identify what the state_dict does not hold: l2_normalized (model.normalized), forward hooks, k_dims and a tag.
+    :param model:
+    :param k_dims:
+    :param tag:
+    :return: hex string
+    """
+    hooks = sorted(getattr(hook, '__name__', type(hook).__name__)
+                   for hook in getattr(model, '_forward_hooks', {}).values())
+    desc = [str(bool(getattr(model, 'normalized', False))), ','.join(hooks), str(k_dims), str(tag)]
+    return hashlib.md5('|'.join(desc).encode()).hexdigest()
+
+
+class EmbeddingStore(object):
+    """
+    extract once, then load. an entry is a directory holding embeddings.npy, labels.npy, fnames.npy (if the dataset
+    has fnames) and meta.json, written to a temporary directory and renamed, so a crashed run leaves no entry.
+    """
+    def __init__(self, root=STORE_DIR, engine=None, verbose=True):
+        """
+        :param root: directory of all entries
+        :param engine: EmbeddingEngine used on a miss, default on the device of the model
+        :param verbose:
+        """
+        self.root = root
+        self.engine = engine if engine is not None else EmbeddingEngine()
+        self.verbose = verbose
+
+    def key(self, dataset, model=None, checkpoint=None, k_dims=None, tag=None):
+        """
+        :param dataset:
+        :param model: its state_dict is hashed without checkpoint, its output options (model.normalized, forward
+        hooks) always
+        :param checkpoint:
+        :param k_dims:
+        :param tag: anything else changing the embeddings
+        :return: string
+        """
+        return '{}_{}_{}_{}'.format(checkpoint_hash(checkpoint=checkpoint, model=model)[:16],
+                                    dataset_hash(dataset)[:16],
+                                    scaler_hash(getattr(dataset, 'transform', None))[:8],
+                                    output_hash(model, k_dims=k_dims, tag=tag)[:8])
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self.root, key, 'meta.json'))
+
+    def load(self, key):
+        """
+        :param key:
+        :return: dict of embeddings (memory mapped), labels and fnames (None if not stored)
+        """
+        path = os.path.join(self.root, key)
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        entry = {'embeddings': np.load(os.path.join(path, 'embeddings.npy'), mmap_mode='r'),
+                 'labels': np.load(os.path.join(path, 'labels.npy')),
+                 'fnames': np.load(os.path.join(path, 'fnames.npy')) if meta['fnames'] else None}
+        return entry
+
+    def extract(self, loader, model, k_dims=None, checkpoint=None, tag=None):
+        """
+        drop-in for utils.utilities.extract_embeddings, the network runs only on a miss.
+        :param loader: DataLoader iterating its dataset once in order
+        :param model: with the weights of checkpoint loaded
+        :param k_dims:
+        :param checkpoint: file the weights were loaded from, default the model state_dict is hashed
+        :param tag: optional, separates entries of otherwise identical keys
+        :return: embeddings (memory mapped) and labels
+        """
+        key = self.key(loader.dataset, model=model, checkpoint=checkpoint, k_dims=k_dims, tag=tag)
+        if not self.contains(key):
+            self._write(key, loader, model, k_dims, checkpoint)
+        elif self.verbose:
+            print('[EmbeddingStore:]Loaded', key)
+        entry = self.load(key)
+        return entry['embeddings'], entry['labels']
+
+    def _write(self, key, loader, model, k_dims, checkpoint):
+        tmp_path = os.path.join(self.root, key + '.tmp{}'.format(os.getpid()))
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        _, labels = self.engine.extract(loader, model, k_dims=k_dims,
+                                        memmap_path=os.path.join(tmp_path, 'embeddings.npy'))
+        np.save(os.path.join(tmp_path, 'labels.npy'), labels)
+        fnames = getattr(loader.dataset, 'fnames', None)
+        if fnames is not None:
+            np.save(os.path.join(tmp_path, 'fnames.npy'), np.asarray(fnames))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'checkpoint': checkpoint, 'dataset': type(loader.dataset).__name__,
+                       'n_samples': len(labels), 'fnames': fnames is not None}, f, indent=2)
+        try:
+            os.rename(tmp_path, os.path.join(self.root, key))
+        except OSError:
+            # written concurrently by another run, keep theirs
+            shutil.rmtree(tmp_path)
+        if self.verbose:
+            print('[EmbeddingStore:]Saved', key)
+
+    def clear(self):
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
@@ -0,0 +1,487 @@
+import time
+import numpy as np
+from utils.utilities import knn_search, knn_vote, knn_vote_all_k
+
+"""
+kNN galleries: search indexes over stored embeddings and a kNN classifier on top of them.
+every index has build(gallery), search(query, k) -> (indices, squared euclidean distances) sorted by ascending
+distance, and save(path) / load_index(path). ExactIndex is the brute-force baseline, IVFIndex clusters the gallery
+with k-means and only scans the lists of the n_probe nearest centroids of every query. Float16Index, Int8Index and
+PQIndex keep a compressed gallery (2, 1 and n_subspaces / dims bytes per dimension).
+"""
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=0, block_size=1024):
+    """
+    Lloyd's k-means with random initial centroids, empty clusters are re-seeded with random samples.
+    :param x: numpy of shape (n_samples, dims)
+    :param n_clusters:
+    :param n_iter: maximum iterations, stops earlier when the assignment no longer changes
+    :param seed:
+    :param block_size: samples assigned at once
+    :return: centroids (n_clusters, dims) float32, assignment (n_samples, ) int64
+    """
+    random_state = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    n_clusters = min(n_clusters, len(x))
+    centroids = x[random_state.choice(len(x), n_clusters, replace=False)].copy()
+    assign = None
+    for _ in range(n_iter):
+        new_assign = knn_search(x, centroids, k=1, block_size=block_size)[0][:, 0]
+        if assign is not None and np.array_equal(new_assign, assign):
+            break
+        assign = new_assign
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.stack([np.bincount(assign, weights=x[:, j], minlength=n_clusters) for j in range(x.shape[1])], 1)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty].reshape(-1, 1)
+        centroids[empty] = x[random_state.choice(len(x), empty.sum(), replace=False)]
+    return centroids, assign
+
+
+class GalleryIndex(object):
+    """
+    base class, subclasses set kind, implement build, search and _arrays, and are rebuilt from _arrays by load_index.
+    """
+    kind = None
+
+    def build(self, gallery):
+        raise NotImplementedError
+
+    def search(self, query, k):
+        raise NotImplementedError
+
+    def _arrays(self):
+        raise NotImplementedError
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        raise NotImplementedError
+
+    @property
+    def nbytes(self):
+        return sum(np.asarray(a).nbytes for a in self._arrays().values())
+
+    def save(self, path):
+        np.savez(path, kind=self.kind, **self._arrays())
+
+
+class ExactIndex(GalleryIndex):
+    """
+    brute-force search, see utils.utilities.knn_search.
+    """
+    kind = 'exact'
+
+    def __init__(self, normalized=False, block_size=1024):
+        self.normalized = normalized
+        self.block_size = block_size
+        self.vectors = None
+
+    def build(self, gallery):
+        self.vectors = np.asarray(gallery, dtype=np.float32)
+        return self
+
+    def search(self, query, k):
+        return knn_search(np.asarray(query, dtype=np.float32), self.vectors, k=k, block_size=self.block_size,
+                          normalized=self.normalized)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def _arrays(self):
+        return {'vectors': self.vectors, 'normalized': self.normalized, 'block_size': self.block_size}
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        index = cls(normalized=bool(arrays['normalized']), block_size=int(arrays['block_size']))
+        index.vectors = arrays['vectors']
+        return index
+
+
+class IVFIndex(GalleryIndex):
+    """
+    inverted file index: the gallery is partitioned by k-means into n_lists lists, a query only computes distances
+    to the members of the n_probe lists whose centroids are nearest. n_probe = n_lists is exact search.
+    the returned distances are exact for the returned neighbours, queries with less than k candidates get index -1
+    and distance inf in the missing slots, n_probe x (n_gallery / n_lists) should stay well above k.
+    """
+    kind = 'ivf'
+
+    def __init__(self, n_lists=None, n_probe=8, n_train=None, n_iter=20, seed=0, block_size=1024):
+        """
+        :param n_lists: number of k-means lists, default sqrt(n_gallery)
+        :param n_probe: lists scanned per query
+        :param n_train: samples k-means is trained on, default 64 per list
+        :param n_iter: k-means iterations
+        :param seed:
+        :param block_size: queries searched at once
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_train = n_train
+        self.n_iter = n_iter
+        self.seed = seed
+        self.block_size = block_size
+        self.centroids = None
+        # gallery sorted by list, list l is vectors[offsets[l]:offsets[l + 1]], ids maps back to gallery indices
+        self.vectors = None
+        self.square_norm = None
+        self.ids = None
+        self.offsets = None
+
+    def build(self, gallery):
+        gallery = np.asarray(gallery, dtype=np.float32)
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(gallery))))
+        n_train = min(len(gallery), self.n_train or 64 * n_lists)
+        sample = np.random.RandomState(self.seed).choice(len(gallery), n_train, replace=False)
+        self.centroids, _ = kmeans(gallery[sample], n_lists, n_iter=self.n_iter, seed=self.seed,
+                                   block_size=self.block_size)
+        assign = knn_search(gallery, self.centroids, k=1, block_size=self.block_size)[0][:, 0]
+        self.ids = np.argsort(assign, kind='stable')
+        self.vectors = gallery[self.ids]
+        self.square_norm = (self.vectors ** 2).sum(axis=1)
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=len(self.centroids)))))
+        return self
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query, k):
+        query = np.asarray(query, dtype=np.float32)
+        n_probe = min(self.n_probe, len(self.centroids))
+        list_size = np.diff(self.offsets)
+        max_size = int(list_size.max())
+        k = min(k, len(self.ids))
+        indices = np.full([len(query), k], -1, dtype=np.int64)
+        distances = np.full([len(query), k], np.inf, dtype=np.float32)
+
+        for start in range(0, len(query), self.block_size):
+            block = query[start:start + self.block_size]
+            probe = knn_search(block, self.centroids, k=n_probe, block_size=self.block_size)[0]
+            # candidate distances of (query, probe slot, list position), inf past the end of a list
+            candidate = np.full([len(block), n_probe, max_size], np.inf, dtype=np.float32)
+            # queries grouped by probed list, one matmul per list
+            order = np.argsort(probe.reshape(-1), kind='stable')
+            bounds = np.searchsorted(probe.reshape(-1)[order], np.arange(len(self.centroids) + 1))
+            for l in np.nonzero(np.diff(bounds))[0]:
+                cells = order[bounds[l]:bounds[l + 1]]
+                rows, slots = cells // n_probe, cells % n_probe
+                members = slice(self.offsets[l], self.offsets[l + 1])
+                candidate[rows, slots, :list_size[l]] = self.square_norm[members].reshape(1, -1) - \
+                    2 * np.dot(block[rows], self.vectors[members].T)
+            candidate = candidate.reshape(len(block), -1)
+            if k < candidate.shape[1]:
+                selected = np.argpartition(candidate, k - 1, axis=1)[:, :k]
+            else:
+                selected = np.tile(np.arange(candidate.shape[1]), (len(block), 1))
+            partial = np.take_along_axis(candidate, selected, axis=1)
+            rank = np.argsort(partial, axis=1)
+            selected = np.take_along_axis(selected, rank, axis=1)
+            partial = np.take_along_axis(partial, rank, axis=1)
+            lists = np.take_along_axis(probe, selected // max_size, axis=1)
+            position = self.offsets[lists] + selected % max_size
+            found = np.isfinite(partial)
+            stop = start + len(block)
+            indices[start:stop][found] = self.ids[np.minimum(position, len(self.ids) - 1)][found]
+            distances[start:stop] = partial + (block ** 2).sum(axis=1, keepdims=True)
+        return indices, distances
+
+    def _arrays(self):
+        return {'centroids': self.centroids, 'vectors': self.vectors, 'ids': self.ids, 'offsets': self.offsets,
+                'n_probe': self.n_probe, 'block_size': self.block_size}
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        index = cls(n_lists=len(arrays['centroids']), n_probe=int(arrays['n_probe']),
+                    block_size=int(arrays['block_size']))
+        index.centroids, index.vectors = arrays['centroids'], arrays['vectors']
+        index.ids, index.offsets = arrays['ids'], arrays['offsets']
+        index.square_norm = (index.vectors ** 2).sum(axis=1)
+        return index
+
+
+class EncodedIndex(GalleryIndex):
+    """
+    brute-force search over a compressed gallery. queries are searched in blocks against gallery chunks, a chunk is
+    decoded (or scored from lookup tables) only while it is compared, so memory stays at the size of the codes.
+    subclasses implement build and _decode, or _distances directly.
+    """
+    def __init__(self, block_size=1024, chunk_size=16384):
+        """
+        :param block_size: queries searched at once
+        :param chunk_size: gallery samples scored at once
+        """
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def _decode(self, start, stop):
+        raise NotImplementedError
+
+    def _distances(self, query, start, stop):
+        gallery = self._decode(start, stop)
+        return (gallery ** 2).sum(axis=1).reshape(1, -1) - 2 * np.dot(query, gallery.T) + \
+            (query ** 2).sum(axis=1, keepdims=True)
+
+    def search(self, query, k):
+        query = np.asarray(query, dtype=np.float32)
+        k = min(k, self.n)
+        indices = np.zeros([len(query), k], dtype=np.int64)
+        distances = np.zeros([len(query), k], dtype=np.float32)
+        for start in range(0, len(query), self.block_size):
+            block = query[start:start + self.block_size]
+            best_index = np.zeros([len(block), 0], dtype=np.int64)
+            best_distance = np.zeros([len(block), 0], dtype=np.float32)
+            for chunk in range(0, self.n, self.chunk_size):
+                partial = self._distances(block, chunk, min(chunk + self.chunk_size, self.n))
+                # k best of the chunk, then k best of those and the running best
+                if k < partial.shape[1]:
+                    selected = np.argpartition(partial, k - 1, axis=1)[:, :k]
+                    partial = np.take_along_axis(partial, selected, axis=1)
+                else:
+                    selected = np.tile(np.arange(partial.shape[1]), (len(block), 1))
+                best_index = np.concatenate((best_index, selected + chunk), axis=1)
+                best_distance = np.concatenate((best_distance, partial), axis=1)
+                if best_index.shape[1] > k:
+                    selected = np.argpartition(best_distance, k - 1, axis=1)[:, :k]
+                    best_index = np.take_along_axis(best_index, selected, axis=1)
+                    best_distance = np.take_along_axis(best_distance, selected, axis=1)
+            order = np.argsort(best_distance, axis=1)
+            indices[start:start + len(block)] = np.take_along_axis(best_index, order, axis=1)
+            distances[start:start + len(block)] = np.take_along_axis(best_distance, order, axis=1)
+        return indices, distances
+
+
+class Float16Index(EncodedIndex):
+    """
+    gallery stored as float16, 2 bytes per dimension.
+    """
+    kind = 'float16'
+
+    def build(self, gallery):
+        self.vectors = np.asarray(gallery, dtype=np.float16)
+        self.n = len(self.vectors)
+        return self
+
+    def _decode(self, start, stop):
+        return self.vectors[start:stop].astype(np.float32)
+
+    def _arrays(self):
+        return {'vectors': self.vectors, 'block_size': self.block_size, 'chunk_size': self.chunk_size}
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        index = cls(block_size=int(arrays['block_size']), chunk_size=int(arrays['chunk_size']))
+        index.vectors = arrays['vectors']
+        index.n = len(index.vectors)
+        return index
+
+
+class Int8Index(EncodedIndex):
+    """
+    per-dimension scalar quantization, 1 byte per dimension: x = low + scale * code with code in 0..255 spanning the
+    gallery range of every dimension.
+    """
+    kind = 'int8'
+
+    def build(self, gallery):
+        gallery = np.asarray(gallery, dtype=np.float32)
+        self.low = gallery.min(axis=0)
+        self.scale = np.maximum(gallery.max(axis=0) - self.low, 1e-12) / 255
+        self.codes = np.zeros(gallery.shape, dtype=np.uint8)
+        for start in range(0, len(gallery), self.chunk_size):
+            chunk = gallery[start:start + self.chunk_size]
+            self.codes[start:start + len(chunk)] = np.clip(np.rint((chunk - self.low) / self.scale), 0, 255)
+        self.n = len(self.codes)
+        return self
+
+    def _decode(self, start, stop):
+        return self.low + self.scale * self.codes[start:stop].astype(np.float32)
+
+    def _arrays(self):
+        return {'codes': self.codes, 'low': self.low, 'scale': self.scale, 'block_size': self.block_size,
+                'chunk_size': self.chunk_size}
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        index = cls(block_size=int(arrays['block_size']), chunk_size=int(arrays['chunk_size']))
+        index.codes, index.low, index.scale = arrays['codes'], arrays['low'], arrays['scale']
+        index.n = len(index.codes)
+        return index
+
+
+class PQIndex(EncodedIndex):
+    """
+    product quantization: the dimensions are split into n_subspaces groups, every group is coded by the nearest of
+    256 k-means centroids, 1 byte per group. queries are not quantized (asymmetric distance): a lookup table of the
+    distances between every query group and every centroid is built once per query block, the distance to a gallery
+    sample is then the sum of n_subspaces table entries. distances are approximate.
+    """
+    kind = 'pq'
+
+    def __init__(self, n_subspaces=8, n_train=16384, n_iter=20, seed=0, block_size=1024, chunk_size=16384):
+        """
+        :param n_subspaces: bytes per gallery sample, must divide the embedding dims
+        :param n_train: samples the codebooks are trained on
+        :param n_iter: k-means iterations
+        :param seed:
+        """
+        super(PQIndex, self).__init__(block_size=block_size, chunk_size=chunk_size)
+        self.n_subspaces = n_subspaces
+        self.n_train = n_train
+        self.n_iter = n_iter
+        self.seed = seed
+
+    def build(self, gallery):
+        gallery = np.asarray(gallery, dtype=np.float32)
+        assert gallery.shape[1] % self.n_subspaces == 0, (gallery.shape[1], self.n_subspaces)
+        sub_dims = gallery.shape[1] // self.n_subspaces
+        sample = gallery[np.random.RandomState(self.seed).choice(len(gallery), min(self.n_train, len(gallery)),
+                                                                 replace=False)]
+        self.codebooks = np.zeros([self.n_subspaces, 256, sub_dims], dtype=np.float32)
+        self.codes = np.zeros([len(gallery), self.n_subspaces], dtype=np.uint8)
+        for j in range(self.n_subspaces):
+            group = slice(j * sub_dims, (j + 1) * sub_dims)
+            centroids, _ = kmeans(sample[:, group], 256, n_iter=self.n_iter, seed=self.seed + j)
+            # with less than 256 training samples the remaining centroids stay unused
+            self.codebooks[j, :len(centroids)] = centroids
+            self.codes[:, j] = knn_search(gallery[:, group], centroids, k=1)[0][:, 0]
+        self.n = len(self.codes)
+        return self
+
+    def _distances(self, query, start, stop):
+        sub_dims = self.codebooks.shape[2]
+        codes = self.codes[start:stop]
+        # accumulated as (gallery, query), gathering whole table rows is much faster than single entries
+        distances = np.zeros([stop - start, len(query)], dtype=np.float32)
+        for j in range(self.n_subspaces):
+            group = query[:, j * sub_dims:(j + 1) * sub_dims]
+            # (256, n_query) lookup table of this group
+            table = (self.codebooks[j] ** 2).sum(axis=1, keepdims=True) - 2 * np.dot(self.codebooks[j], group.T) + \
+                (group ** 2).sum(axis=1).reshape(1, -1)
+            distances += table[codes[:, j]]
+        return distances.T
+
+    def _arrays(self):
+        return {'codes': self.codes, 'codebooks': self.codebooks, 'block_size': self.block_size,
+                'chunk_size': self.chunk_size}
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        index = cls(n_subspaces=arrays['codes'].shape[1], block_size=int(arrays['block_size']),
+                    chunk_size=int(arrays['chunk_size']))
+        index.codes, index.codebooks = arrays['codes'], arrays['codebooks']
+        index.n = len(index.codes)
+        return index
+
+
+INDEX_TYPES = {cls.kind: cls for cls in (ExactIndex, IVFIndex, Float16Index, Int8Index, PQIndex)}
+
+
+def load_index(path):
+    """
+    :param path: file written by GalleryIndex.save
+    :return: index of the saved type
+    """
+    with np.load(path) as f:
+        arrays = {name: f[name] for name in f.files}
+    return INDEX_TYPES[str(arrays.pop('kind'))]._from_arrays(arrays)
+
+
+def recall_report(index, query, gallery, k=10, n_probes=None, block_size=1024):
+    """
+    recall@k of an index against exact search: the fraction of the exact k nearest neighbours it returns.
+    :param index: built index
+    :param query: numpy of shape (n_query, dims)
+    :param gallery: numpy the index was built from
+    :param k:
+    :param n_probes: IVFIndex only, recall of every n_probe in the list
+    :param block_size: of the exact search
+    :return: list of dict with n_probe, recall, query time and speedup over exact search
+    """
+    query = np.asarray(query, dtype=np.float32)
+    start = time.time()
+    exact, _ = knn_search(query, np.asarray(gallery, dtype=np.float32), k=k, block_size=block_size)
+    exact_time = time.time() - start
+
+    report = []
+    default_n_probe = getattr(index, 'n_probe', None)
+    for n_probe in (n_probes if n_probes is not None else [default_n_probe]):
+        if n_probe is not None:
+            index.n_probe = n_probe
+        start = time.time()
+        approx, _ = index.search(query, k)
+        approx_time = time.time() - start
+        hits = sum(np.intersect1d(a, e).size for a, e in zip(approx, exact))
+        report.append({'n_probe': n_probe, 'recall': hits / exact.size, 'time': approx_time,
+                       'speedup': exact_time / max(approx_time, 1e-9)})
+        print('[ANN:]{} n_probe={} recall@{} {:.4f}, {:.3f}s ({:.1f}x exact)'.format(
+            index.kind, n_probe, k, report[-1]['recall'], approx_time, report[-1]['speedup']))
+    if default_n_probe is not None:
+        index.n_probe = default_n_probe
+    return report
+
+
+def encoding_report(gallery, gallery_labels, query, query_labels, indexes=None, k=3, cls_num=10):
+    """
+    accuracy versus memory of gallery encodings: bytes per gallery sample, recall@k against exact search and kNN
+    accuracy of every index.
+    :param gallery: numpy of shape (n_gallery, dims)
+    :param gallery_labels:
+    :param query: numpy of shape (n_query, dims)
+    :param query_labels:
+    :param indexes: unbuilt indexes, default ExactIndex, Float16Index, Int8Index and PQIndex
+    :param k:
+    :param cls_num:
+    :return: list of dict with kind, bytes per sample, recall and accuracy
+    """
+    gallery = np.asarray(gallery, dtype=np.float32)
+    query = np.asarray(query, dtype=np.float32)
+    query_labels = np.asarray(query_labels, dtype=np.int64)
+    if indexes is None:
+        indexes = [ExactIndex(), Float16Index(), Int8Index(), PQIndex(n_subspaces=8)]
+    exact, _ = knn_search(query, gallery, k=k)
+
+    report = []
+    for index in indexes:
+        index.build(gallery)
+        neighbours, _ = index.search(query, k)
+        hits = sum(np.intersect1d(a, e).size for a, e in zip(neighbours, exact))
+        acc = np.mean(KNNClassifier(index, gallery_labels, k=k, cls_num=cls_num).predict(query) == query_labels)
+        report.append({'kind': index.kind, 'bytes': index.nbytes / len(gallery), 'recall': hits / exact.size,
+                       'acc': acc})
+        print('[Gallery:]{:8} {:7.1f} bytes/sample, recall@{} {:.4f}, acc {:.4f}'.format(
+            index.kind, report[-1]['bytes'], k, report[-1]['recall'], acc))
+    return report
+
+
+class KNNClassifier(object):
+    """
+    inference with a kNN gallery: majority vote of the labels of the k nearest gallery samples.
+    """
+    def __init__(self, index, labels, k=3, cls_num=10):
+        """
+        :param index: built GalleryIndex
+        :param labels: gallery labels, in the order the index was built from
+        :param k:
+        :param cls_num:
+        """
+        self.index = index
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.k = k
+        self.cls_num = cls_num
+
+    def predict(self, query):
+        """
+        :param query: numpy of shape (n_query, dims)
+        :return: numpy of shape (n_query, ) predicted classes
+        """
+        neighbours, _ = self.index.search(query, self.k)
+        if (neighbours >= 0).all():
+            return knn_vote(self.labels[neighbours], self.cls_num)
+        # missing neighbours (-1) of an approximate index do not vote
+        weights = (neighbours >= 0).astype(np.float64)
+        return knn_vote_all_k(self.labels[neighbours], self.cls_num, weights=weights)[:, -1]
@@ -0,0 +1,149 @@
+import os
+import json
+import fcntl
+import time
+import socket
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import BatchSampler, RandomSampler
+
+"""
+DataLoader auto-tuning: probe throughput over a grid of worker counts and prefetch factors, cache the best
+configuration per machine and dataset fingerprint, and build loaders with it.
+"""
+
+
+def default_loader_kwargs():
+    # used when a dataset is too small to be probed, never cached
+    return {'num_workers': 0, 'pin_memory': torch.cuda.is_available()}
+
+
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'asc_triplet', 'loader_tuning.json')
+
+
+def dataset_fingerprint(dataset, batch_size):
+    """
+    identify machine, dataset and batch size, the tuned configuration is only reused when all of them match.
+    :param dataset:
+    :param batch_size:
+    :return: hex string
+    """
+    data = getattr(dataset, 'data', None)
+    desc = [socket.gethostname(), str(os.cpu_count()), str(torch.cuda.is_available()),
+            type(dataset).__name__, str(len(dataset)), str(batch_size),
+            str(getattr(data, 'shape', None)), str(getattr(data, 'dtype', None)),
+            type(getattr(dataset, 'transform', None)).__name__]
+    return hashlib.md5('|'.join(desc).encode()).hexdigest()
+
+
+def _throughput(dataset, batch_size, n_batches, **loader_kwargs):
+    # probe with a random batch sampler of the same size, the real sampler state is left untouched
+    batch_size = min(batch_size, len(dataset))
+    if batch_size == 0:
+        return 0.0
+    batch_sampler = BatchSampler(RandomSampler(dataset), batch_size=batch_size, drop_last=True)
+    loader = DataLoader(dataset=dataset, batch_sampler=batch_sampler, **loader_kwargs)
+    n_loaded = 0
+    iterator = iter(loader)
+    # warm up, worker start up is not counted
+    if next(iterator, None) is None:
+        return 0.0
+    start = time.time()
+    for _ in iterator:
+        n_loaded += 1
+        if n_loaded >= n_batches:
+            break
+    return n_loaded * batch_size / max(time.time() - start, 1e-6)
+
+
+def probe_loader(dataset, batch_size=128, workers=(0, 1, 2, 4, 8), prefetch_factors=(2, 4, 8), n_batches=20,
+                 verbose=True):
+    """
+    measure loading throughput (samples per second) for every worker count and prefetch factor.
+    :param dataset:
+    :param batch_size:
+    :param workers: candidate num_workers, values above cpu count are skipped
+    :param prefetch_factors: candidate prefetch_factor, only for num_workers > 0
+    :param n_batches: batches timed for every configuration
+    :param verbose:
+    :return: dict of best DataLoader kwargs (None if no configuration loaded a timed batch, e.g. the dataset holds
+    less than two batches) and list of (kwargs, throughput)
+    """
+    pin_memory = torch.cuda.is_available()
+    state = np.random.get_state()
+    results = []
+    for num_workers in workers:
+        if num_workers > (os.cpu_count() or 1):
+            continue
+        for prefetch_factor in (prefetch_factors if num_workers > 0 else (None,)):
+            kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory}
+            if num_workers > 0:
+                kwargs['prefetch_factor'] = prefetch_factor
+                kwargs['persistent_workers'] = True
+            throughput = _throughput(dataset, batch_size, n_batches, **kwargs)
+            results.append((kwargs, throughput))
+            print('[LoaderTuner:]{} {:.1f} samples/s'.format(kwargs, throughput)) if verbose else None
+    np.random.set_state(state)
+
+    measured = [r for r in results if r[1] > 0]
+    best = max(measured, key=lambda r: r[1])[0] if len(measured) > 0 else None
+    return best, results
+
+
+def tuned_loader_kwargs(dataset, batch_size=128, cache_file=CACHE_FILE, **probe_kwargs):
+    """
+    return the cached best DataLoader kwargs of this machine and dataset, probe and cache them on first use.
+    :param dataset:
+    :param batch_size:
+    :param cache_file: json file shared by all experiments
+    :param probe_kwargs: passed to probe_loader
+    :return: dict of DataLoader kwargs, default_loader_kwargs() if the dataset is too small to be probed
+    """
+    key = dataset_fingerprint(dataset, batch_size)
+    if not os.path.exists(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # concurrently started scripts probe one after another and all keep their entries
+    with open(cache_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            cache = {}
+            if os.path.exists(cache_file):
+                with open(cache_file, 'r') as f:
+                    cache = json.load(f)
+            if key not in cache:
+                best, _ = probe_loader(dataset, batch_size=batch_size, **probe_kwargs)
+                if best is None:
+                    return default_loader_kwargs()
+                cache[key] = best
+                with open(cache_file + '.tmp', 'w') as f:
+                    json.dump(cache, f, indent=2)
+                os.replace(cache_file + '.tmp', cache_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return dict(cache[key])
+
+
+def tuned_loader(dataset, batch_size=128, batch_sampler=None, shuffle=False, cache_file=CACHE_FILE, **probe_kwargs):
+    """
+    build a DataLoader with tuned num_workers, prefetch_factor, pin_memory and persistent_workers.
+    works for balanced training loaders (batch_sampler) used by train_epoch, and for plain loaders used by
+    extract_embeddings and kNN.
+    :param dataset:
+    :param batch_size: ignored if batch_sampler given
+    :param batch_sampler:
+    :param shuffle: ignored if batch_sampler given
+    :param cache_file:
+    :param probe_kwargs: passed to probe_loader
+    :return: DataLoader
+    """
+    if batch_sampler is not None:
+        batch_size = batch_sampler.batch_size
+    kwargs = tuned_loader_kwargs(dataset, batch_size=batch_size, cache_file=cache_file, **probe_kwargs)
+    if hasattr(dataset, 'set_epoch'):
+        # persistent workers would keep serving the triplets of the first epoch
+        kwargs.pop('persistent_workers', None)
+    if batch_sampler is not None:
+        return DataLoader(dataset=dataset, batch_sampler=batch_sampler, **kwargs)
+    return DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
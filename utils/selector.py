@@ -1,6 +1,7 @@
 from itertools import combinations
 import numpy as np
 import torch
+from utils.utilities import pairwise_distance
 
 def pdist(vectors):
     """
@@ -85,41 +86,136 @@ class FunctionNegativeTripletSelector(object):
         return torch.LongTensor(triplets)
 
 
-def HardestNegativeTripletSelector(margin, cpu=False):
-    return FunctionNegativeTripletSelector(margin=margin, negative_selection_fn=hardest_negative, cpu=cpu)
+class TensorNegativeTripletSelector(object):
+    """
+    vectorized version of FunctionNegativeTripletSelector with hardest_negative, random_hard_negative or
+    semihard_negative, runs on the device of the embeddings.
+    for every anchor, negatives are sorted by distance once. loss = ap - an + margin is then monotone in an, so the
+    hard negatives of a pair (a, p) are a prefix of that order (an < ap + margin), the semi-hard ones a range
+    (ap < an < ap + margin). both ranges are found with one batched searchsorted, and a uniform draw inside the range
+    gives the random choice. the only host sync is the final number of triplets.
+    """
+    def __init__(self, margin, selection='hardest', cpu=False, normalized=False):
+        assert selection in ('hardest', 'random_hard', 'semihard'), selection
+        self.cpu = cpu
+        self.margin = margin
+        self.selection = selection
+        # unit length embeddings, squared distances from dot products only
+        self.normalized = normalized
+
+    def get_triplets(self, embeddings, labels):
+        if self.cpu:
+            embeddings = embeddings.cpu()
+        with torch.no_grad():
+            distance_matrix = pairwise_distance(embeddings, squared=True, normalized=True) if self.normalized \
+                else pdist(embeddings)
+            labels = labels.to(distance_matrix.device)
+            n = len(labels)
+            labels_equal = torch.eq(labels.unsqueeze(0), labels.unsqueeze(1))
+            # all anchor-positive pairs (a < p), same as combinations(label_indices, 2)
+            anchor_positive = labels_equal & torch.ones_like(labels_equal).triu(diagonal=1)
+
+            # negatives of every anchor in ascending distance, other entries pushed to the end
+            negative_dist = distance_matrix.masked_fill(labels_equal, float('inf'))
+            sorted_dist, sorted_indices = torch.sort(negative_dist, dim=1)
+
+            # hard: an < ap + margin, semi-hard: also an > ap
+            hard_count = torch.searchsorted(sorted_dist, distance_matrix + self.margin, right=False)
+            if self.selection == 'hardest':
+                low = torch.zeros_like(hard_count)
+                rank = low
+            else:
+                low = torch.searchsorted(sorted_dist, distance_matrix, right=True) if self.selection == 'semihard' \
+                    else torch.zeros_like(hard_count)
+                uniform = torch.rand(n, n, device=distance_matrix.device)
+                rank = low + (uniform * (hard_count - low).clamp(min=0).to(uniform.dtype)).long()
+            valid = anchor_positive & torch.gt(hard_count, low)
+
+            rank = rank.clamp(max=n - 1)
+            negatives = torch.gather(sorted_indices, 1, rank)
+            anchors = torch.arange(n, device=distance_matrix.device).view(-1, 1).expand(n, n)
+            positives = anchors.t()
+            triplets = torch.stack((anchors[valid], positives[valid], negatives[valid]), dim=1)
+
+            if len(triplets) == 0:
+                # keep one triplet, the first anchor-positive pair with its nearest negative. without any pair or
+                # negative (e.g. small random batches, one class) the result stays empty
+                pairs = torch.nonzero(anchor_positive & torch.isfinite(sorted_dist[:, :1]))
+                if len(pairs) > 0:
+                    pair = pairs[0]
+                    triplets = torch.stack((pair[0], pair[1], sorted_indices[pair[0], 0])).view(1, 3)
+
+        return triplets.long()
+
 
+def HardestNegativeTripletSelector(margin, cpu=False, normalized=False):
+    return TensorNegativeTripletSelector(margin=margin, selection='hardest', cpu=cpu, normalized=normalized)
 
-def RandomNegativeTripletSelector(margin, cpu=False):
-    return FunctionNegativeTripletSelector(margin=margin, negative_selection_fn=random_hard_negative, cpu=cpu)
 
+def RandomNegativeTripletSelector(margin, cpu=False, normalized=False):
+    return TensorNegativeTripletSelector(margin=margin, selection='random_hard', cpu=cpu, normalized=normalized)
 
-def SemihardNegativeTripletSelector(margin, cpu=False):
-    return FunctionNegativeTripletSelector(margin=margin, negative_selection_fn=lambda x: semihard_negative(x, margin), cpu=cpu)
+
+def SemihardNegativeTripletSelector(margin, cpu=False, normalized=False):
+    return TensorNegativeTripletSelector(margin=margin, selection='semihard', cpu=cpu, normalized=normalized)
 
 
 class BatchAllTripletSelector(object):
     """
     combination all samples in one mini-batch.
     return index of triplets.
+    only triplets with positive loss (ap - an + margin > 0) are kept, as a compact (n_triplets, 3) tensor. they are
+    enumerated class by class in anchor chunks of at most memory_budget candidates, so no
+    (batch_size, batch_size, batch_size) tensor is built. RandomHardTripletLoss(soft_margin=False) on these triplets
+    is the batch all triplet loss.
     """
-    def __init__(self, margin):
+    def __init__(self, margin, squared=False, memory_budget=2 ** 22, normalized=False):
+        """
+        :param margin: margin for triplet loss
+        :param squared: distances used for selection, should match the loss
+        :param memory_budget: max number of (anchor, positive, negative) candidates compared at once
+        :param normalized: unit length embeddings, distances from dot products only
+        """
         self.margin = margin
+        self.squared = squared
+        self.memory_budget = memory_budget
+        self.normalized = normalized
 
     def get_triplets(self, embeddings, labels):
-        labels = labels.data.numpy()
-        triplets = []
-
-        for label in set(labels):
-            label_mask = (labels == label)
-            label_indices = np.where(label_mask)[0]
-            if len(label_indices) < 2:
-                continue
-            anchor_positives = list(combinations(label_indices, 2))  # All anchor-positive pairs
-            anchor_positives = np.array(anchor_positives)
-            negative_indices = np.where(np.logical_not(label_mask))[0]
-
-
-
+        with torch.no_grad():
+            distance_matrix = pairwise_distance(embeddings, squared=self.squared, normalized=self.normalized)
+            labels = labels.to(distance_matrix.device)
+            triplets = []
+            # first valid (anchor, positive, negative), kept when no triplet violates the margin
+            fallback = None
+
+            for label in torch.unique(labels):
+                label_mask = torch.eq(labels, label)
+                label_indices = torch.nonzero(label_mask).view(-1)
+                negative_indices = torch.nonzero(~label_mask).view(-1)
+                if len(label_indices) < 2 or len(negative_indices) == 0:
+                    continue
+                if fallback is None:
+                    fallback = torch.stack((label_indices[0], label_indices[1], negative_indices[0])).view(1, 3)
+
+                chunk_size = max(1, self.memory_budget // (len(label_indices) * len(negative_indices)))
+                for start in range(0, len(label_indices), chunk_size):
+                    anchors = label_indices[start: start + chunk_size]
+                    anchor_dist = distance_matrix[anchors]
+                    # shape (chunk_size, n_positives, n_negatives)
+                    loss_values = anchor_dist[:, label_indices].unsqueeze(2) - \
+                        anchor_dist[:, negative_indices].unsqueeze(1) + self.margin
+                    distinct = torch.ne(anchors.unsqueeze(1), label_indices.unsqueeze(0)).unsqueeze(2)
+                    a, p, n = torch.nonzero(torch.gt(loss_values, 0) & distinct, as_tuple=True)
+                    triplets.append(torch.stack((anchors[a], label_indices[p], negative_indices[n]), dim=1))
+
+            triplets = torch.cat(triplets, dim=0) if triplets else \
+                torch.zeros(0, 3, dtype=torch.long, device=distance_matrix.device)
+            if len(triplets) == 0 and fallback is not None:
+                # keep one (easy) triplet so the loss is defined, its hinge is zero
+                triplets = fallback
+
+        return triplets.long()
 
 
 if __name__ == '__main__':
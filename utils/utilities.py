@@ -2,6 +2,8 @@ import torch
 import numpy as np
 import os
 import torch.nn.functional as F
+from collections import OrderedDict
+from utils.embedding_engine import EmbeddingEngine
 
 
 # visualization module
@@ -37,18 +39,19 @@ def plot_embeddings(embeddings, targets, cls_num=10, xlim=None, ylim=None, title
     plt.show()
 
 
-def extract_embeddings(dataloader, model, k_dims):
-    with torch.no_grad():
-        model.eval()
-        embeddings = np.zeros([len(dataloader.dataset), k_dims])
-        labels = np.zeros(len(dataloader.dataset))
-        k = 0
-        for images, target in dataloader:
-            images = images.cuda()
-            embeddings[k:k+len(images)] = model.get_embeddings(images).data.cpu().numpy()
-            labels[k:k+len(images)] = target.numpy()
-            k += len(images)
-        return embeddings, labels
+def extract_embeddings(dataloader, model, k_dims, device=None, num_threads=None, memmap_path=None):
+    """
+    embeddings of every sample of dataloader, see utils.embedding_engine.EmbeddingEngine.
+    :param dataloader: DataLoader iterating its dataset once in order
+    :param model:
+    :param k_dims: embedding dims
+    :param device: default the device of the model
+    :param num_threads: cpu inference threads
+    :param memmap_path: optional .npy file the embeddings are streamed to
+    :return: float32 embeddings of shape (n_samples, k_dims), int64 labels of shape (n_samples, )
+    """
+    engine = EmbeddingEngine(device=device, num_threads=num_threads)
+    return engine.extract(dataloader, model, k_dims=k_dims, memmap_path=memmap_path)
 
 
 def get_distance_matrix2(matrix1, matrix2):
@@ -63,24 +66,156 @@ def get_distance_matrix2(matrix1, matrix2):
     return distance_matrix
 
 
-def pairwise_distance(embeddings, squared=False):
+def nearest_neighbour_graph(embeddings, labels, k=10, block_size=1024):
+    """
+    build a dataset-wide k-NN graph, for every sample find its k nearest neighbours with a different label.
+    rows are processed in blocks, so peak memory is block_size x n_samples instead of n_samples x n_samples.
+    :param embeddings: numpy of shape (n_samples, embed_dims)
+    :param labels: numpy of shape (n_samples, )
+    :param k: number of other-class neighbours kept for each sample
+    :param block_size: number of rows computed at once
+    :return: numpy int64 of shape (n_samples, k), neighbours of each row sorted by ascending distance
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    labels = np.asarray(labels)
+    k = min(k, len(labels) - 1)
+    square_norm = (embeddings ** 2).sum(axis=1)
+    graph = np.zeros([len(embeddings), k], dtype=np.int64)
+
+    for start in range(0, len(embeddings), block_size):
+        stop = min(start + block_size, len(embeddings))
+        distance = -2 * np.dot(embeddings[start:stop], embeddings.T) + square_norm[start:stop].reshape(-1, 1) + \
+                   square_norm.reshape(1, -1)
+        # same-class samples (including itself) are never negatives
+        distance[labels[start:stop].reshape(-1, 1) == labels.reshape(1, -1)] = np.inf
+        # partial selection of the k smallest, then sort only those k
+        neighbours = np.argpartition(distance, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(distance, neighbours, axis=1), axis=1)
+        graph[start:stop] = np.take_along_axis(neighbours, order, axis=1)
+
+    return graph
+
+
+def knn_search(query, gallery, k, block_size=1024, normalized=False):
+    """
+    k nearest gallery samples of every query, computed in blocks of queries with partial selection, peak memory is
+    block_size x n_gallery.
+    :param query: numpy of shape (n_query, embed_dims)
+    :param gallery: numpy of shape (n_gallery, embed_dims)
+    :param k: number of neighbours
+    :param block_size: number of queries computed at once
+    :param normalized: embeddings are unit length, neighbours are ranked by dot product
+    :return: indices (n_query, k) int64 and squared euclidean distances (n_query, k), sorted by ascending distance
+    """
+    k = min(k, len(gallery))
+    # ||q||^2 is constant along a row, it does not change the ranking and is only added to the k selected
+    gallery_norm = np.ones(len(gallery), dtype=gallery.dtype) if normalized else (gallery ** 2).sum(axis=1)
+    indices = np.zeros([len(query), k], dtype=np.int64)
+    distances = np.zeros([len(query), k], dtype=np.result_type(query, gallery))
+
+    for start in range(0, len(query), block_size):
+        stop = min(start + block_size, len(query))
+        partial = gallery_norm.reshape(1, -1) - 2 * np.dot(query[start:stop], gallery.T)
+        if k < len(gallery):
+            neighbours = np.argpartition(partial, k - 1, axis=1)[:, :k]
+        else:
+            neighbours = np.tile(np.arange(len(gallery)), (stop - start, 1))
+        partial = np.take_along_axis(partial, neighbours, axis=1)
+        order = np.argsort(partial, axis=1)
+        indices[start:stop] = np.take_along_axis(neighbours, order, axis=1)
+        query_norm = 1 if normalized else (query[start:stop] ** 2).sum(axis=1, keepdims=True)
+        distances[start:stop] = np.take_along_axis(partial, order, axis=1) + query_norm
+
+    return indices, distances
+
+
+def knn_vote(neighbour_labels, cls_num):
+    """
+    majority vote over the labels of the k neighbours of every query, ties go to the smallest class.
+    :param neighbour_labels: int numpy of shape (n_query, k)
+    :param cls_num: number of classes
+    :return: numpy of shape (n_query, ), predicted classes
+    """
+    neighbour_labels = np.asarray(neighbour_labels, dtype=np.int64)
+    n_query = len(neighbour_labels)
+    # one bincount over (query, class) cells
+    cells = (np.arange(n_query).reshape(-1, 1) * cls_num + neighbour_labels).reshape(-1)
+    class_cnt = np.bincount(cells, minlength=n_query * cls_num).reshape(n_query, cls_num)
+    return np.argmax(class_cnt, axis=1)
+
+
+def knn_vote_all_k(neighbour_labels, cls_num, weights=None):
+    """
+    votes of every k in 1..K from one neighbour table, the class counts of k are the cumulative sum of the first k
+    neighbours. ties go to the smallest class.
+    :param neighbour_labels: int numpy of shape (n_query, K), neighbours sorted by ascending distance
+    :param cls_num: number of classes
+    :param weights: optional numpy of shape (n_query, K), vote weight of each neighbour, default 1
+    :return: numpy of shape (n_query, K), column k - 1 holds the predictions with k neighbours
+    """
+    neighbour_labels = np.asarray(neighbour_labels, dtype=np.int64)
+    n_query, k_max = neighbour_labels.shape
+    class_cnt = np.zeros([n_query, k_max, cls_num])
+    np.put_along_axis(class_cnt, neighbour_labels[:, :, None],
+                      (np.ones([n_query, k_max]) if weights is None else weights)[:, :, None], axis=2)
+    return np.argmax(np.cumsum(class_cnt, axis=1), axis=2)
+
+
+def pairwise_distance(embeddings, squared=False, normalized=False):
     """
     Compute the 2D matrix of distance between all the embeddings.
     :param embeddings: tensor of shape (batch_size, embed_dim)
     :param squared: Boolean. If true, output is the pairwise squared euclidean distance matrix.
                     If false, output is the pairwise euclidean distance matrix.
+    :param normalized: Boolean. If true, embeddings are unit length and the squared distance is 2 - 2 * dot product,
+                       a single matmul without norms. squared=True then needs no sqrt either.
     :return: pairwise_distances: tensor of shape (batch_size, batch_size)
     """
     dot_product = torch.matmul(embeddings, embeddings.t())
-    square_norm = dot_product.diag()
-    distances = square_norm.unsqueeze(1) - 2 * dot_product + square_norm.unsqueeze(0)
-    distances = F.relu(distances)
+    if normalized:
+        distances = F.relu(2 - 2 * dot_product)
+    else:
+        square_norm = dot_product.diag()
+        distances = square_norm.unsqueeze(1) - 2 * dot_product + square_norm.unsqueeze(0)
+        distances = F.relu(distances)
+
+    if not squared:
+        distances = sqrt_distance(distances)
+    return distances
+
+
+def sqrt_distance(distances):
+    """
+    euclidean distances from squared ones, zero distances get zero gradient instead of inf.
+    :param distances: tensor of squared distances, non negative
+    :return: tensor of same shape
+    """
+    mask = torch.eq(distances, 0.0).float()
+    distances = distances + mask * 1e-16
+    distances = torch.sqrt(distances)
+    distances = distances * (1.0 - mask)
+    return distances
+
+
+def cross_distance(embeddings1, embeddings2, squared=False, normalized=False):
+    """
+    Compute the 2D matrix of distance between two sets of embeddings, same formula as pairwise_distance.
+    :param embeddings1: tensor of shape (n1, embed_dim)
+    :param embeddings2: tensor of shape (n2, embed_dim)
+    :param squared: Boolean. If true, output is the squared euclidean distance matrix.
+    :param normalized: Boolean. If true, embeddings are unit length, see pairwise_distance.
+    :return: distances: tensor of shape (n1, n2)
+    """
+    dot_product = torch.matmul(embeddings1, embeddings2.t())
+    if normalized:
+        distances = F.relu(2 - 2 * dot_product)
+    else:
+        distances = embeddings1.pow(2).sum(dim=1).unsqueeze(1) - 2 * dot_product + \
+                    embeddings2.pow(2).sum(dim=1).unsqueeze(0)
+        distances = F.relu(distances)
 
     if not squared:
-        mask = torch.eq(distances, 0.0).float()
-        distances = distances + mask * 1e-16
-        distances = torch.sqrt(distances)
-        distances = distances * (1.0 - mask)
+        distances = sqrt_distance(distances)
     return distances
 
 
@@ -93,24 +228,22 @@ def get_triplet_mask(labels):
         - labels[i] == labels[j] and labels[i] != labels[k]
 
     :param labels: shape of tensor (batch_size, )
-    :return: 3D mask
+    :return: 3D bool mask
     """
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
     # check that i, j and k are distinct
-    indices_not_same = torch.eye(labels.shape[0]).to(device).byte() ^ 1
+    indices_not_same = ~torch.eye(labels.shape[0], dtype=torch.bool, device=labels.device)
     i_not_equal_j = torch.unsqueeze(indices_not_same, 2)
     i_not_equal_k = torch.unsqueeze(indices_not_same, 1)
     j_not_equal_k = torch.unsqueeze(indices_not_same, 0)
-    distinct_indices = i_not_equal_j * i_not_equal_k * j_not_equal_k
+    distinct_indices = i_not_equal_j & i_not_equal_k & j_not_equal_k
 
     # check if labels[i] == labels[j] and labels[j] != labels[k]
     label_equal = torch.eq(torch.unsqueeze(labels, 0), torch.unsqueeze(labels, 1))
     i_equal_j = torch.unsqueeze(label_equal, 2)
     i_equal_k = torch.unsqueeze(label_equal, 1)
-    valid_labels = i_equal_j * (i_equal_k ^ 1)
+    valid_labels = i_equal_j & ~i_equal_k
 
-    mask = distinct_indices * valid_labels # combine the two masks
+    mask = distinct_indices & valid_labels # combine the two masks
 
     return mask
 
@@ -119,18 +252,16 @@ def get_anchor_positive_triplet_mask(labels):
     """
     Return a 2D mask where mask[a, p] is True iff a and p are distinct and have same label.
     :param labels: tensor of shape (batch_size, )
-    :return: tensor of shape (batch_size, batch_size)
+    :return: bool tensor of shape (batch_size, batch_size)
     """
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
     # check that i and j are distinct
-    indices_not_equal = torch.eye(labels.shape[0]).to(device).byte() ^ 1
+    indices_not_equal = ~torch.eye(labels.shape[0], dtype=torch.bool, device=labels.device)
 
     # check if labels[i] == labels[j]
     labels_equal = torch.unsqueeze(labels, 0) == torch.unsqueeze(labels, 1)
 
     # combine the two masks
-    mask = indices_not_equal * labels_equal
+    mask = indices_not_equal & labels_equal
 
     return mask
 
@@ -139,16 +270,127 @@ def get_anchor_negative_triplet_mask(labels):
     """
     return a 2D mask where mask[a, n] is True iff a and n have distinct labels.
     :param labels: tensor of shape (batch_size, )
-    :return: tensor of shape (batch_size, batch_size)
+    :return: bool tensor of shape (batch_size, batch_size)
     """
 
     # check if labels[i] != labels[k]
     labels_equal = torch.unsqueeze(labels, 0) == torch.unsqueeze(labels, 1)
-    mask = labels_equal ^ 1
+    mask = ~labels_equal
 
     return mask
 
 
+class LabelMasks(object):
+    """
+    bool masks of one canonical label layout, every mask is built on first access and then kept.
+    """
+    def __init__(self, labels):
+        self.labels = labels
+        self._anchor_positive = None
+        self._anchor_negative = None
+        self._triplet = None
+
+    @property
+    def anchor_positive(self):
+        if self._anchor_positive is None:
+            self._anchor_positive = get_anchor_positive_triplet_mask(self.labels)
+        return self._anchor_positive
+
+    @property
+    def anchor_negative(self):
+        if self._anchor_negative is None:
+            self._anchor_negative = get_anchor_negative_triplet_mask(self.labels)
+        return self._anchor_negative
+
+    @property
+    def triplet(self):
+        if self._triplet is None:
+            self._triplet = get_triplet_mask(self.labels)
+        return self._triplet
+
+
+class MaskProvider(object):
+    """
+    cache triplet and pair masks by label layout and device.
+    a batch is reordered into class-sorted order, its layout is then only the tuple of class sizes, so every batch of
+    BalanceBatchSampler (n_classes x n_samples) hits the same cache entry whatever classes were drawn.
+    """
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+
+    def __call__(self, embeddings, labels):
+        """
+        :param embeddings: tensor of shape (batch_size, embed_dim)
+        :param labels: tensor of shape (batch_size, )
+        :return: class-sorted embeddings, class-sorted labels and their LabelMasks
+        """
+        order = torch.argsort(labels, stable=True)
+        labels = labels[order]
+        _, counts = torch.unique_consecutive(labels, return_counts=True)
+        key = (tuple(counts.tolist()), str(labels.device))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            canonical_labels = torch.repeat_interleave(torch.arange(len(counts), device=labels.device), counts)
+            self._cache[key] = LabelMasks(canonical_labels)
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return embeddings[order], labels, self._cache[key]
+
+
+mask_provider = MaskProvider()
+
+
+class PairwiseBatch(object):
+    """
+    per-batch quantities shared by several losses: class-sorted embeddings and labels, label masks, pairwise distances
+    (squared and not) and gaussian kernels. each one is computed on first use, then reused by every loss of the batch.
+    """
+    def __init__(self, embeddings, labels, normalized=False):
+        """
+        :param embeddings: tensor of shape (batch_size, embed_dim)
+        :param labels: tensor of shape (batch_size, )
+        :param normalized: embeddings are unit length, distances come from dot products only
+        """
+        self.embeddings, self.labels, self.masks = mask_provider(embeddings, labels)
+        self.normalized = normalized
+        self._cache = {}
+
+    def cached(self, key, fn):
+        if key not in self._cache:
+            self._cache[key] = fn()
+        return self._cache[key]
+
+    def distance(self, squared=False):
+        """
+        :param squared: Boolean. If true, squared euclidean distances, the euclidean ones are derived from them.
+        :return: tensor of shape (batch_size, batch_size)
+        """
+        if squared:
+            return self.cached(('distance', True), lambda: pairwise_distance(self.embeddings, squared=True,
+                                                                                normalized=self.normalized))
+        return self.cached(('distance', False), lambda: sqrt_distance(self.distance(squared=True)))
+
+    def kernel(self, squared=False, kernel_width=None):
+        """
+        gaussian kernel exp(-gamma * d^2) of the pairwise distances, without grad.
+        :param squared: distance d is squared euclidean if True
+        :param kernel_width: None for a per-anchor width, the distance to the 8th nearest sample (itself included)
+        :return: tensor of shape (batch_size, batch_size)
+        """
+        def build():
+            with torch.no_grad():
+                distances = self.distance(squared).detach()
+                if kernel_width is None:
+                    delta, _ = torch.kthvalue(distances, k=min(8, distances.shape[1]), dim=1, keepdim=True)
+                    gamma = 0.5 * (delta ** 2 + 1e-16)
+                else:
+                    gamma = 1 / 2 * (kernel_width ** 2 + 1e-16)
+                return distances.pow(2).mul_(-gamma).exp_()
+        return self.cached(('kernel', squared, kernel_width), build)
+
+
 class Reporter(object):
     def __init__(self, ckpt_root, exp, ckpt_file=None):
         self.ckpt_root = ckpt_root
@@ -4,6 +4,7 @@ from data_manager.mean_variance import *
 from torchvision.transforms import Compose
 from torch.utils.data import DataLoader
 import numpy as np
+import torch
 import networks
 import matplotlib.pyplot as plt
 
@@ -13,112 +14,194 @@ def get_distance_matrix(vector):
     return distance_matrix
 
 
-def verification(model, mode='test', device='a'):
+def verification(model, mode='test', device='a', show_fig=False, streaming=False, loader=None):
     """
     get the equal error rate through verification set.
     :param model:
     :param mode:
     :param device:
-    :return:
-    """
-    standarizer = TaskbStandarizer(data_manager=Dcase18TaskbData())
-    mu, sigma = standarizer.load_mu_sigma(mode='train', device='a')
-    test_dataset = DevSet(mode=mode, device=device, transform=Compose([
-        Normalize(mean=mu, std=sigma),
-        ToTensor()
-    ]))
-
-    test_loader = DataLoader(dataset=test_dataset, batch_size=128, shuffle=False, num_workers=1)
-    total_embeddings = np.zeros([len(test_loader.dataset), 64])
-    labels = np.zeros([len(test_loader.dataset)])
-    k = 0
-    with torch.no_grad():
-        model.eval()
-        for batch_id, (data, target) in enumerate(test_loader):
-            data = data.cuda()
-            total_embeddings[k:k+len(data)] = model.get_embeddings(data).data.cpu().numpy()
-            labels[k:k+len(data)] = target.numpy()
-            k += len(data)
-
-    distance_matrix = get_distance_matrix(total_embeddings)
-    total_distance = []
-    total_target = []
-    labels_set = set(test_dataset.labels)
-    label_to_indices = {label: np.where(test_dataset.labels == label)[0] for label in labels_set}
-    length = len(test_dataset.labels)
-    vis = np.zeros([length, length])
-    for i in range(length):
-        vis[i][i] = 1
-
-    for label in label_to_indices.keys():
-        for sample1 in label_to_indices[label]:
-            for sample2 in label_to_indices[label]:
-                if vis[sample1][sample2] == 0:
-                    total_distance.append(distance_matrix[sample1][sample2])
-                    total_target.append(1)
-                    vis[sample1][sample2] = 1
-                    vis[sample2][sample1] = 1
-            left_set = labels_set - set([label])
-            for left_label in left_set:
-                for sample2 in label_to_indices[left_label]:
-                    if vis[sample1][sample2] == 0:
-                        total_distance.append(distance_matrix[sample1][sample2])
-                        total_target.append(0)
-                        vis[sample1][sample2] = 1
-                        vis[sample2][sample1] = 1
-
-    eer = EER(total_distance, total_target, True)
+    :param show_fig: plot FAR and FRR curves
+    :param streaming: score trials into histograms (streaming_verification), constant memory for large sets
+    :param loader: DataLoader of the verification set iterated once in order, e.g. utils.loader_tuner.tuned_loader,
+    default a plain loader of DevSet(mode, device), nothing is probed
+    :return: EER as float, the same rates on both paths
+    """
+    if loader is None:
+        standarizer = TaskbStandarizer(data_manager=Dcase18TaskbData())
+        mu, sigma = standarizer.load_mu_sigma(mode='train', device='a')
+        test_dataset = DevSet(mode=mode, device=device, transform=Compose([
+            Normalize(mean=mu, std=sigma),
+            ToTensor()
+        ]))
+        loader = DataLoader(dataset=test_dataset, batch_size=128, shuffle=False, num_workers=1,
+                            pin_memory=torch.cuda.is_available())
+    total_embeddings, labels = extract_embeddings(loader, model, 64)
+
+    if streaming:
+        return streaming_verification(total_embeddings, labels)['eer']
+    total_distance, total_target = trial_scores(total_embeddings, labels)
+    eer = EER(total_distance, total_target, show_fig)
     print('ERR is: ', eer)
+    return eer
+
 
+def trial_scores(embeddings, labels, block_size=1024):
+    """
+    every unordered pair (i < j) of samples is one verification trial, scored by the squared euclidean distance.
+    rows are processed in blocks, only the upper triangle of each block is kept.
+    :param embeddings: numpy of shape (n_samples, embed_dims)
+    :param labels: numpy of shape (n_samples, )
+    :param block_size: number of rows computed at once
+    :return: distances (n_trials, ) and targets (n_trials, ), 1 if the pair has the same label else 0
+    """
+    square_norm = (embeddings ** 2).sum(axis=1)
+    distances = []
+    targets = []
+    for start in range(0, len(embeddings), block_size):
+        stop = min(start + block_size, len(embeddings))
+        block = -2.0 * np.dot(embeddings[start:stop], embeddings[start + 1:].T) + \
+            square_norm[start:stop].reshape(-1, 1) + square_norm[start + 1:].reshape(1, -1)
+        # column j of the block is sample start + 1 + j, keep j >= row
+        upper = np.arange(stop - start).reshape(-1, 1) <= np.arange(len(embeddings) - start - 1).reshape(1, -1)
+        distances.append(block[upper])
+        targets.append((labels[start:stop].reshape(-1, 1) == labels[start + 1:].reshape(1, -1))[upper])
+    return np.concatenate(distances), np.concatenate(targets).astype(np.int64)
 
 
 def EER(distance, target, show_fig=False):
     """
     give distance list and true label(non-target or target), compute equal error rate.
-    :param distance:
-    :param target:
-    :param show_fig:
-    :return:
-    """
-    index = sorted(range(len(distance)), key=lambda k: distance[k])
-    distance.sort()
-    target = np.array(target)
-    target = target[index]
-    eps = 1e-6
-    up_sum = np.ones([len(distance)])
-    up_sum = np.cumsum(up_sum == 1)
-    down_sum = np.ones([len(distance)]) * len(distance)
-    down_sum = down_sum - up_sum
-    down_sum[-1] += eps
-    FA = np.cumsum(target == 0)
-    target_reverse = target[::-1]
-    FR = np.cumsum(target_reverse == 1)
-    FR = FR[::-1]
-    FAR = FA / up_sum
-    FRR = FR / down_sum
-    x = np.arange(0, len(FAR), 1)
-    plt.figure()
-    plt.plot(x, FAR)
-    plt.title('FAR')
-    plt.figure()
-    plt.plot(x, FRR)
-    plt.title("FRR")
+    one argsort, FAR and FRR of every threshold come from cumulative sums. a trial is accepted when its distance is
+    below the threshold, FAR = accepted non-targets / non-targets, FRR = rejected targets / targets, the same rates
+    as histogram_metrics.
+    :param distance: list or numpy of trial distances
+    :param target: list or numpy, 1 for target trials, 0 for non-target trials
+    :param show_fig: plot FAR, FRR and the DET-like curve
+    :return: float, mean of FAR and FRR where they are closest
+    """
+    distance = np.asarray(distance)
+    index = np.argsort(distance, kind='stable')
+    target = np.asarray(target)[index]
+    # thresholds accepting the first 0..n sorted trials
+    FAR = np.concatenate(([0], np.cumsum(target == 0))) / max(np.sum(target == 0), 1)
+    FRR = 1 - np.concatenate(([0], np.cumsum(target == 1))) / max(np.sum(target == 1), 1)
 
     if show_fig:
+        x = np.arange(0, len(FAR), 1)
+        plt.figure()
+        plt.plot(x, FAR)
+        plt.title('FAR')
+        plt.figure()
+        plt.plot(x, FRR)
+        plt.title("FRR")
         plt.figure()
         plt.plot(FRR, FAR)
         plt.show()
-    diff = np.abs(FAR - FRR)
-    EER_index = np.where(diff == np.min(diff))
+    EER_index = int(np.argmin(np.abs(FAR - FRR)))
     print('FAR: ', FAR[EER_index])
     print('FRR: ', FRR[EER_index])
-    return FAR[EER_index]
+    return float((FAR[EER_index] + FRR[EER_index]) / 2)
+
+
+def trial_histograms(embeddings, labels, n_bins=2 ** 16, block_size=1024, max_distance=None):
+    """
+    streaming version of trial_scores: histograms of target and non-target trial distances (squared euclidean),
+    accumulated over block_size x block_size tiles of the upper triangle. memory does not depend on the number of
+    clips, embeddings may be a numpy memmap.
+    :param embeddings: numpy of shape (n_samples, embed_dims)
+    :param labels: numpy of shape (n_samples, )
+    :param n_bins: number of equal-width bins on [0, max_distance]
+    :param block_size: tile size
+    :param max_distance: upper bound of trial distances, default (2 * max norm)^2, which bounds every pair
+    :return: bin edges (n_bins + 1, ), target histogram (n_bins, ), non-target histogram (n_bins, )
+    """
+    labels = np.asarray(labels)
+    n = len(labels)
+    square_norm = np.concatenate([(np.asarray(embeddings[start:start + block_size], dtype=np.float64) ** 2).sum(axis=1)
+                                  for start in range(0, n, block_size)])
+    if max_distance is None:
+        max_distance = 4.0 * square_norm.max() + 1e-12
+    bin_width = max_distance / n_bins
+    target_hist = np.zeros(n_bins, dtype=np.int64)
+    nontarget_hist = np.zeros(n_bins, dtype=np.int64)
+
+    for row in range(0, n, block_size):
+        row_embeddings = np.asarray(embeddings[row:row + block_size], dtype=np.float64)
+        for col in range(row, n, block_size):
+            col_embeddings = np.asarray(embeddings[col:col + block_size], dtype=np.float64)
+            distance = -2.0 * np.dot(row_embeddings, col_embeddings.T) + \
+                square_norm[row:row + block_size].reshape(-1, 1) + square_norm[col:col + block_size].reshape(1, -1)
+            target = labels[row:row + block_size].reshape(-1, 1) == labels[col:col + block_size].reshape(1, -1)
+            if col == row:
+                # diagonal tile, pairs i < j only
+                upper = np.triu(np.ones(distance.shape, dtype=bool), k=1)
+                distance, target = distance[upper], target[upper]
+            bins = np.clip((distance / bin_width).astype(np.int64), 0, n_bins - 1).reshape(-1)
+            target = target.reshape(-1)
+            target_hist += np.bincount(bins[target], minlength=n_bins)
+            nontarget_hist += np.bincount(bins[~target], minlength=n_bins)
+
+    edges = np.arange(n_bins + 1) * bin_width
+    return edges, target_hist, nontarget_hist
+
+
+def histogram_metrics(edges, target_hist, nontarget_hist, p_target=0.01, c_miss=1.0, c_fa=1.0):
+    """
+    EER, minDCF and ROC from trial histograms, with thresholds at the bin edges. a trial is accepted when its
+    distance is below the threshold, FAR = accepted non-targets / non-targets, FRR = rejected targets / targets.
+    FAR and FRR are exact at every edge. the exact EER lies inside the bin where FAR and FRR cross, the returned EER
+    is the middle of the range allowed by that bin and eer_error_bound its half width, so |EER - exact| <= bound.
+    :param edges: bin edges (n_bins + 1, )
+    :param target_hist: (n_bins, )
+    :param nontarget_hist: (n_bins, )
+    :param p_target: prior of target trials for the detection cost
+    :param c_miss: cost of a miss (false rejection)
+    :param c_fa: cost of a false acceptance
+    :return: dict with eer, eer_error_bound, eer_threshold, min_dcf (normalized), min_dcf_threshold and roc (far, frr)
+    """
+    # rates at thresholds edges[0..n_bins], threshold edges[i] accepts bins < i
+    far = np.concatenate(([0], np.cumsum(nontarget_hist))) / max(nontarget_hist.sum(), 1)
+    frr = 1 - np.concatenate(([0], np.cumsum(target_hist))) / max(target_hist.sum(), 1)
+
+    # first edge where FAR >= FRR, the crossing is between it and the previous one
+    i = max(int(np.argmax(far >= frr)), 1)
+    low = max(far[i - 1], frr[i])
+    high = min(far[i], frr[i - 1])
+    low, high = min(low, high), max(low, high)
+
+    dcf = c_miss * p_target * frr + c_fa * (1 - p_target) * far
+    dcf = dcf / min(c_miss * p_target, c_fa * (1 - p_target))
+    j = int(np.argmin(dcf))
+    return {'eer': float((low + high) / 2), 'eer_error_bound': float((high - low) / 2),
+            'eer_threshold': float(edges[i]), 'min_dcf': float(dcf[j]), 'min_dcf_threshold': float(edges[j]),
+            'roc': (far, frr)}
+
+
+def streaming_verification(embeddings, labels, n_bins=2 ** 16, block_size=1024, max_distance=None, p_target=0.01):
+    """
+    all-pairs verification in constant memory, see trial_histograms and histogram_metrics.
+    :return: dict of histogram_metrics
+    """
+    edges, target_hist, nontarget_hist = trial_histograms(embeddings, labels, n_bins=n_bins, block_size=block_size,
+                                                          max_distance=max_distance)
+    result = histogram_metrics(edges, target_hist, nontarget_hist, p_target=p_target)
+    print('[Verification:]EER {:.4f} (+-{:.4f}), minDCF {:.4f}'.format(result['eer'], result['eer_error_bound'],
+                                                                      result['min_dcf']))
+    return result
 
 
 from utils.utilities import *
+from utils.gallery import KNNClassifier
 
 
-def kNN(model, train_loader, test_loader, k=3, embed_dims=64, cls_num=10):
+def kNN(model, train_loader, test_loader, k=3, embed_dims=64, cls_num=10, normalized=False, block_size=1024,
+        index=None):
+    """
+    kNN accuracy of the test embeddings against the train embeddings.
+    :param normalized: embeddings are unit length, neighbours are ranked by dot product (one matmul, no norms)
+    :param block_size: number of test samples searched at once, bounds memory to block_size x n_train distances
+    :param index: optional unbuilt utils.gallery index (e.g. IVFIndex(n_probe=16)) searched instead of brute force
+    """
 
     if type(train_loader) is dict:
         embedding_A, labels_A = extract_embeddings(train_loader['a'], model, embed_dims)
@@ -131,22 +214,198 @@ def kNN(model, train_loader, test_loader, k=3, embed_dims=64, cls_num=10):
         train_embedding, train_labels = extract_embeddings(train_loader, model, embed_dims)
         test_embedding, test_labels = extract_embeddings(test_loader, model, embed_dims)
 
-    distance_matrix = get_distance_matrix2(test_embedding, train_embedding)
-    sorted_index = np.argsort(distance_matrix, axis=1)
-    predict_labels = []
-    for i in range(len(test_embedding)):
-        class_cnt = np.zeros([cls_num])
-        k_neighbor = train_labels[sorted_index[i]]
-        for j in range(k):
-            class_cnt[int(k_neighbor[j])] += 1
-        predict_labels.append(np.argmax(class_cnt))
-    predict_labels = np.array(predict_labels)
+    if index is not None:
+        predict_labels = KNNClassifier(index.build(train_embedding), train_labels, k=k, cls_num=cls_num).predict(
+            test_embedding)
+    else:
+        # k smallest distances by partial selection, then one bincount vote
+        neighbours, _ = knn_search(test_embedding, train_embedding, k=k, block_size=block_size,
+                                   normalized=normalized)
+        predict_labels = knn_vote(train_labels[neighbours], cls_num)
     # test_acc = (test_labels == predict_labels).sum() / len(test_labels)
     test_acc = np.mean(test_labels == predict_labels)
     return test_acc
 
 
+class GalleryEvaluator(object):
+    """
+    kNN evaluation of many query splits against one gallery. every dataset is embedded at most once per model
+    state: embeddings are cached by dataset and reused until a parameter or buffer of the model changes (in-place
+    updates of the optimizer bump the tensor versions). a split declared in unions as the concatenation of other
+    splits (e.g. DevSet device 'bc' = 'b' + 'c') reuses their embeddings.
+    with index, a callable returning an unbuilt utils.gallery index (e.g. IVFIndex), the gallery is searched through
+    that index, built once per gallery and model state.
+    """
+    def __init__(self, model, embed_dims=64, normalized=False, block_size=1024, index=None, unions=None):
+        """
+        :param model:
+        :param embed_dims:
+        :param normalized: embeddings are unit length
+        :param block_size: number of queries searched at once
+        :param index: callable returning an unbuilt utils.gallery index, default brute force
+        :param unions: dict of split name -> tuple of split names whose datasets concatenated in order are its
+        dataset, e.g. {'bc': ('b', 'c')}
+        """
+        self.model = model
+        self.embed_dims = embed_dims
+        self.normalized = normalized
+        self.block_size = block_size
+        self.index = index
+        self.unions = dict(unions) if unions is not None else {}
+        self._state = None
+        self._cache = {}
+        self._index_cache = {}
+
+    def _model_state(self):
+        return tuple((id(t), t._version) for t in list(self.model.parameters()) + list(self.model.buffers()))
+
+    def embed(self, loader):
+        """
+        :param loader: DataLoader iterating its dataset once in order (no batch sampler)
+        :return: embeddings and labels of the dataset
+        """
+        state = self._model_state()
+        if state != self._state:
+            self._state = state
+            self._cache = {}
+            self._index_cache = {}
+        # keyed by the dataset object itself, which stays alive, so an id is never reused by another dataset
+        if loader.dataset not in self._cache:
+            self._cache[loader.dataset] = extract_embeddings(loader, self.model, self.embed_dims)
+        return self._cache[loader.dataset]
+
+    def embed_splits(self, loaders):
+        """
+        :param loaders: dict of split name -> DataLoader
+        :return: dict of split name -> (embeddings, labels)
+        """
+        loaders = dict(loaders)
+        splits = {}
+        # single splits first, unions are then assembled from them
+        unions = [name for name in loaders if self._union_parts(name, loaders) is not None]
+        for name in [name for name in loaders if name not in unions] + unions:
+            parts = self._union_parts(name, loaders)
+            if parts is not None:
+                splits[name] = (np.concatenate([splits[part][0] for part in parts]),
+                                np.concatenate([splits[part][1] for part in parts]))
+            else:
+                splits[name] = self.embed(loaders[name])
+        return splits
+
+    def _union_parts(self, name, loaders):
+        # declared parts of name, if they are all plain splits of loaders
+        parts = self.unions.get(name)
+        if parts is None or not all(part in loaders and part not in self.unions for part in parts):
+            return None
+        if len(loaders[name].dataset) != sum(len(loaders[part].dataset) for part in parts):
+            raise ValueError('split {} has {} samples, its parts {} have {}'.format(
+                name, len(loaders[name].dataset), parts, sum(len(loaders[part].dataset) for part in parts)))
+        return parts
+
+    def kNN(self, gallery_loader, query_loaders, k=3, cls_num=10):
+        """
+        :param gallery_loader: DataLoader, or dict of DataLoader concatenated into one gallery
+        :param query_loaders: DataLoader, or dict of split name -> DataLoader
+        :param k:
+        :param cls_num:
+        :return: accuracy, or dict of split name -> accuracy
+        """
+        if type(gallery_loader) is dict:
+            gallery = self.embed_splits(gallery_loader)
+            gallery_embedding = np.concatenate([gallery[name][0] for name in sorted(gallery)])
+            gallery_labels = np.concatenate([gallery[name][1] for name in sorted(gallery)])
+            gallery_key = tuple(gallery_loader[name].dataset for name in sorted(gallery))
+        else:
+            gallery_embedding, gallery_labels = self.embed(gallery_loader)
+            gallery_key = gallery_loader.dataset
+
+        classifier = None
+        if self.index is not None:
+            if gallery_key not in self._index_cache:
+                self._index_cache[gallery_key] = self.index().build(gallery_embedding)
+            classifier = KNNClassifier(self._index_cache[gallery_key], gallery_labels, k=k, cls_num=cls_num)
+
+        single = type(query_loaders) is not dict
+        queries = {None: self.embed(query_loaders)} if single else self.embed_splits(query_loaders)
+        acc = {}
+        for name, (query_embedding, query_labels) in queries.items():
+            if classifier is not None:
+                acc[name] = np.mean(query_labels == classifier.predict(query_embedding))
+                continue
+            neighbours, _ = knn_search(query_embedding, gallery_embedding, k=k, block_size=self.block_size,
+                                       normalized=self.normalized)
+            acc[name] = np.mean(query_labels == knn_vote(gallery_labels[neighbours], cls_num))
+        return acc[None] if single else acc
+
+
+def knn_report_from_embeddings(train_embedding, train_labels, test_embedding, test_labels, k_max=10, cls_num=10,
+                               normalized=False, block_size=1024):
+    """
+    kNN evaluation of every k in 1..k_max and every voting scheme from a single top-k_max neighbour search.
+    voting schemes: 'majority', 'distance' (weight 1 / distance) and 'rank' (weight 1 / rank).
+    :param train_embedding: numpy of shape (n_train, embed_dims)
+    :param train_labels: numpy of shape (n_train, )
+    :param test_embedding: numpy of shape (n_test, embed_dims)
+    :param test_labels: numpy of shape (n_test, )
+    :param k_max:
+    :param cls_num:
+    :param normalized: embeddings are unit length
+    :param block_size: number of test samples searched at once
+    :return: dict, for each scheme a dict with 'acc' (k_max, ), 'per_class_acc' (k_max, cls_num) and
+             'confusion' (k_max, cls_num, cls_num) indexed [k - 1, true, predicted], plus 'best' (scheme, k, acc)
+    """
+    neighbours, distances = knn_search(test_embedding, train_embedding, k=k_max, block_size=block_size,
+                                       normalized=normalized)
+    neighbour_labels = train_labels[neighbours].astype(np.int64)
+    test_labels = np.asarray(test_labels, dtype=np.int64)
+    k_max = neighbours.shape[1]
+    weights = {
+        'majority': None,
+        'distance': 1.0 / (np.sqrt(np.maximum(distances, 0)) + 1e-8),
+        'rank': np.tile(1.0 / np.arange(1, k_max + 1), (len(neighbours), 1)),
+    }
+
+    report = {}
+    best = None
+    for scheme, weight in weights.items():
+        predict_labels = knn_vote_all_k(neighbour_labels, cls_num, weights=weight)
+        # (k_max, cls_num, cls_num) confusion matrices from one bincount
+        cells = (np.arange(k_max).reshape(1, -1) * cls_num + test_labels.reshape(-1, 1)) * cls_num + predict_labels
+        confusion = np.bincount(cells.reshape(-1), minlength=k_max * cls_num * cls_num).reshape(k_max, cls_num, cls_num)
+        acc = np.mean(predict_labels == test_labels.reshape(-1, 1), axis=0)
+        per_class_acc = np.diagonal(confusion, axis1=1, axis2=2) / np.maximum(confusion.sum(axis=2), 1)
+        report[scheme] = {'acc': acc, 'per_class_acc': per_class_acc, 'confusion': confusion}
+        k = int(np.argmax(acc))
+        if best is None or acc[k] > best[2]:
+            best = (scheme, k + 1, float(acc[k]))
+    report['best'] = best
+    return report
+
+
+def kNN_report(model, train_loader, test_loader, k_max=10, embed_dims=64, cls_num=10, normalized=False,
+               block_size=1024):
+    """
+    extract embeddings once and evaluate every k and voting scheme, see knn_report_from_embeddings.
+    """
+    train_embedding, train_labels = extract_embeddings(train_loader, model, embed_dims)
+    test_embedding, test_labels = extract_embeddings(test_loader, model, embed_dims)
+    report = knn_report_from_embeddings(train_embedding, train_labels, test_embedding, test_labels, k_max=k_max,
+                                        cls_num=cls_num, normalized=normalized, block_size=block_size)
+    for scheme in ('majority', 'distance', 'rank'):
+        print('[kNN:]{:9} acc for k=1..{}: {}'.format(scheme, k_max, np.round(report[scheme]['acc'], 4)))
+    print('[kNN:]best {} voting, k={}, acc {:.4f}'.format(*report['best']))
+    return report
+
+
 if __name__ == '__main__':
+    # streaming and exact EER measure the same rates, they agree within the bound of the crossing bin
+    random_state = np.random.RandomState(0)
+    check_labels = random_state.randint(0, 10, 2000)
+    check_embeddings = random_state.randn(10, 8)[check_labels] + 1.5 * random_state.randn(2000, 8)
+    exact_eer = EER(*trial_scores(check_embeddings, check_labels))
+    streaming = streaming_verification(check_embeddings, check_labels)
+    assert abs(streaming['eer'] - exact_eer) <= streaming['eer_error_bound'] + 1e-6, (streaming['eer'], exact_eer)
+
     model = networks.embedding_net_shallow()
     model = model.cuda()
     verification(model=model)
\ No newline at end of file